@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark the packet graph pipeline.
+
+Times every stage (loading a capture into a graph, exchange ratios,
+protocol subgraphs, saving and loading graphs) on the bundled
+Data/network_sim.pcap.zip and on synthetic captures of any size, and
+reports seconds, packets per second and peak RSS per stage as JSON.
+
+Each capture is benchmarked in a child process of its own, so the peak RSS
+of one capture doesn't hide the next one's. Within a capture, peak_rss_mb
+is the high water mark of the process after the stage finished. pps is
+always the capture's packet count over the stage's time, so stages working
+on the graph can be compared with the ones reading the capture.
+
+e.g. python benchmark.py -s 10000,100000 -o before.json
+"""
+import json
+import os
+import platform
+import random
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from datetime import datetime
+from optparse import OptionParser, SUPPRESS_HELP
+try:
+    import resource
+except ImportError:
+    resource = None  # Windows, peak RSS isn't reported
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BUNDLED_ZIP = os.path.normpath(
+    os.path.join(HERE, "..", "Data", "network_sim.pcap.zip"))
+SIZES = "10000,100000,1000000,10000000"
+SCAPY_MAX = 20000  # Scapy dissects about 1000 packets a second
+GRAPH_MAX = 1000000  # a networkx edge per packet costs about 1KB
+PORT = 80  # port used by the protocol_subgraph stage
+
+TCP_PORTS = (80, 80, 443, 443, 443, 22, 8080)
+UDP_PORTS = (53, 123, 5353)
+
+
+def peak_rss_mb():
+    """High water mark of this process's resident set, in MB"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # Reported in bytes on macOS, KB elsewhere
+        return peak / 1048576
+    return peak / 1024
+
+
+def timed(stages, name, packets, func, *args, **kwargs):
+    """Run one stage, record it in stages and return what func returned"""
+    start = time.perf_counter()
+    res = func(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    stages[name] = {
+        "seconds": seconds,
+        "pps": packets / seconds if seconds > 0 else None,
+        "peak_rss_mb": peak_rss_mb()
+    }
+    return res
+
+
+def write_synthetic(out_file, packets, hosts=256, seed=1):
+    """Write a classic pcap file of random TCP and UDP traffic between a
+    number of hosts. The frames are packed directly with struct, as building
+    millions of packets with Scapy would take hours
+    Parameters:
+        out_file: the path to write to
+        packets: the number of packets
+        hosts: the number of MAC/IP hosts talking to each other
+        seed: random seed, the same seed writes the same capture"""
+    rng = random.Random(seed)
+    macs = [struct.pack(">HI", 0x0200, i) for i in range(hosts)]
+    ips = [socket.inet_aton("10.0.%d.%d" % (i // 250, i % 250 + 1))
+           for i in range(hosts)]
+    record = struct.Struct("<IIII")
+    ip_header = struct.Struct(">BBHHHBBH4s4s")
+    tcp_header = struct.Struct(">HHIIBBHHH")
+    udp_header = struct.Struct(">HHHH")
+    start = 1600000000
+    with open(out_file, "wb") as f:
+        f.write(struct.pack("<IHHiIII", 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+        for i in range(packets):
+            a = rng.randrange(hosts)
+            b = rng.randrange(hosts - 1)
+            if b >= a:
+                b += 1
+            payload = bytes(rng.randrange(0, 400))
+            if rng.random() < 0.7:
+                dport = rng.choice(TCP_PORTS)
+                l4 = tcp_header.pack(
+                    rng.randrange(1024, 65536), dport, i, 0, 0x50, 0x18,
+                    65535, 0, 0)
+                proto = 6
+            else:
+                dport = rng.choice(UDP_PORTS)
+                l4 = udp_header.pack(
+                    rng.randrange(1024, 65536), dport, 8 + len(payload), 0)
+                proto = 17
+            length = 20 + len(l4) + len(payload)
+            frame = b"".join((
+                macs[b],
+                macs[a],
+                b"\x08\x00",
+                ip_header.pack(0x45, 0, length, i & 0xFFFF, 0x4000, 64, proto,
+                               0, ips[a], ips[b]),
+                l4,
+                payload
+            ))
+            # A thousand packets a second
+            f.write(record.pack(start + i // 1000, (i % 1000) * 1000,
+                                len(frame), len(frame)))
+            f.write(frame)
+
+
+def count_packets(pcap_file):
+    """Number of records in a pcap or pcapng file"""
+    import graph_funcs as ext
+    return sum(1 for record in ext.raw_records(pcap_file))
+
+
+def bundled_capture(data_dir):
+    """Extract the bundled capture into data_dir
+    Returns a tuple of (pcap path, None) or (None, reason it was skipped)"""
+    if not os.path.exists(BUNDLED_ZIP):
+        return None, "%s not found" % BUNDLED_ZIP
+    with open(BUNDLED_ZIP, "rb") as f:
+        start = f.read(64)
+    if start.startswith(b"version https://git-lfs"):
+        return None, "%s is a Git LFS pointer, run git lfs pull" % BUNDLED_ZIP
+    if not zipfile.is_zipfile(BUNDLED_ZIP):
+        return None, "%s is not a zip file" % BUNDLED_ZIP
+    with zipfile.ZipFile(BUNDLED_ZIP) as z:
+        names = [n for n in z.namelist() if n.endswith((".pcap", ".pcapng"))]
+        if not names:
+            return None, "no capture found in %s" % BUNDLED_ZIP
+        out_file = os.path.join(data_dir, os.path.basename(names[0]))
+        if not os.path.exists(out_file):
+            with z.open(names[0]) as src, open(out_file, "wb") as dst:
+                while True:
+                    block = src.read(1 << 20)
+                    if not block:
+                        break
+                    dst.write(block)
+    return out_file, None
+
+
+def run_stages(pcap_file, scapy_max=SCAPY_MAX, graph_max=GRAPH_MAX,
+               processes=None):
+    """Benchmark every stage on one capture, in this process
+    Parameters:
+        pcap_file: the capture to benchmark
+        scapy_max: skip the Scapy stages for captures with more packets
+        graph_max: above this many packets the later stages run on the flow
+            graph instead of a graph with an edge per packet
+        processes: processes for the sharded stage (None for one per CPU)
+    Returns a dict of results"""
+    import graph_funcs as ext
+    from scapy.all import rdpcap
+    packets = count_packets(pcap_file)
+    res = {
+        "path": pcap_file,
+        "packets": packets,
+        "bytes": os.path.getsize(pcap_file),
+        "stages": {}
+    }
+    stages = res["stages"]
+    if packets <= scapy_max:
+        timed(stages, "file_to_graph", packets, ext.file_to_graph, pcap_file)
+        loaded = timed(stages, "rdpcap", packets, rdpcap, pcap_file)
+        timed(stages, "pcap_graph", packets, ext.pcap_graph, loaded)
+        del loaded
+    flow_graph = timed(stages, "file_to_graph_fast_flow", packets,
+                       ext.file_to_graph, pcap_file, fast=True,
+                       aggregate=ext.AGGREGATE_FLOW)
+    timed(stages, "file_to_graph_sharded_flow", packets, ext.file_to_graph,
+          pcap_file, aggregate=ext.AGGREGATE_FLOW, processes=processes)
+    if packets <= graph_max:
+        G = timed(stages, "file_to_graph_fast", packets, ext.file_to_graph,
+                  pcap_file, fast=True)
+        res["graph"] = "packet"
+    else:
+        G = flow_graph
+        res["graph"] = "flow"
+    res["nodes"] = G.number_of_nodes()
+    res["edges"] = G.number_of_edges()
+    timed(stages, "exchange_ratios", packets, ext.exchange_ratios, G)
+    timed(stages, "protocol_subgraph", packets, ext.protocol_subgraph, G, PORT)
+    timed(stages, "protocol_subgraphs", packets, ext.protocol_subgraphs, G)
+    out_dir = tempfile.mkdtemp(prefix="graph_bench_")
+    try:
+        text_file = os.path.join(out_dir, "graph.edgelist")
+        binary_file = os.path.join(out_dir, "graph.npz")
+        timed(stages, "save_graph", packets, ext.save_graph, G, text_file)
+        timed(stages, "save_graph_binary", packets, ext.save_graph, G,
+              binary_file, binary=True)
+        timed(stages, "load_graph_binary", packets, ext.load_graph, binary_file)
+        res["graph_file_bytes"] = os.path.getsize(text_file)
+        res["binary_file_bytes"] = os.path.getsize(binary_file)
+    finally:
+        for name in os.listdir(out_dir):
+            os.remove(os.path.join(out_dir, name))
+        os.rmdir(out_dir)
+    res["peak_rss_mb"] = peak_rss_mb()
+    return res
+
+
+def run_child(pcap_file, opts):
+    """Benchmark a capture in a fresh process and return its results"""
+    cmd = [
+        sys.executable, os.path.abspath(__file__),
+        "--child", pcap_file,
+        "--scapy-max", str(opts.scapy_max),
+        "--graph-max", str(opts.graph_max),
+        "--processes", str(opts.processes)
+    ]
+    proc = subprocess.run(cmd, cwd=HERE, stdout=subprocess.PIPE)
+    if proc.returncode != 0:
+        return {"path": pcap_file, "error": "exit code %d" % proc.returncode}
+    return json.loads(proc.stdout)
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("-s", "--sizes", dest="sizes", default=SIZES,
+        help="Comma separated packet counts of the synthetic captures "
+        "(default %s)" % SIZES)
+    parser.add_option("-o", "--out", dest="out_file", default=None,
+        help="File to write the JSON results to (default print them)")
+    parser.add_option("-d", "--data-dir", dest="data_dir", default=None,
+        help="Where to keep the generated captures so later runs can reuse "
+        "them (default a temporary folder that is removed afterwards)")
+    parser.add_option("--no-bundled", dest="bundled", action="store_false",
+        default=True, help="Skip the bundled network_sim capture")
+    parser.add_option("--scapy-max", dest="scapy_max", default=SCAPY_MAX,
+        type="int", help="Only run the Scapy stages on captures with at most "
+        "this many packets (default %d)" % SCAPY_MAX)
+    parser.add_option("--graph-max", dest="graph_max", default=GRAPH_MAX,
+        type="int", help="Above this many packets, run the graph stages on "
+        "the flow graph (default %d)" % GRAPH_MAX)
+    parser.add_option("-p", "--processes", dest="processes", default=0,
+        type="int", help="Processes for the sharded stage, 0 for one per "
+        "CPU (default 0)")
+    parser.add_option("--child", dest="child", default=None,
+        help=SUPPRESS_HELP)  # benchmarks one capture in this process
+
+    (opts, args) = parser.parse_args()
+    if opts.child is not None:
+        res = run_stages(opts.child, opts.scapy_max, opts.graph_max,
+                         opts.processes or None)
+        print(json.dumps(res))
+        sys.exit(0)
+
+    data_dir = opts.data_dir
+    keep = data_dir is not None
+    if keep:
+        os.makedirs(data_dir, exist_ok=True)
+    else:
+        data_dir = tempfile.mkdtemp(prefix="pcap_bench_")
+    results = {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "captures": {}
+    }
+    created = []
+    try:
+        if opts.bundled:
+            pcap_file, reason = bundled_capture(data_dir)
+            if pcap_file is None:
+                print("Skipping the bundled capture: %s" % reason,
+                      file=sys.stderr)
+                results["captures"]["network_sim"] = {"skipped": reason}
+            else:
+                created.append(pcap_file)
+                results["captures"]["network_sim"] = run_child(pcap_file, opts)
+        for size in opts.sizes.split(","):
+            n = int(float(size))
+            name = "synthetic_%d" % n
+            pcap_file = os.path.join(data_dir, name + ".pcap")
+            if not os.path.exists(pcap_file):
+                print("Writing %s" % pcap_file, file=sys.stderr)
+                write_synthetic(pcap_file, n)
+            created.append(pcap_file)
+            print("Benchmarking %s" % name, file=sys.stderr)
+            results["captures"][name] = run_child(pcap_file, opts)
+    finally:
+        if not keep:
+            for pcap_file in created:
+                os.remove(pcap_file)
+            os.rmdir(data_dir)
+    out = json.dumps(results, indent=2)
+    if opts.out_file is None:
+        print(out)
+    else:
+        with open(opts.out_file, "w") as f:
+            f.write(out + "\n")
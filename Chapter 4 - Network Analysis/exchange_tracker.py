@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Keep the Information Exchange Ratio of every node up to date as packets
+arrive, instead of rerunning exchange_ratios over the whole graph.
+
+Each node's in and out byte totals are kept as running sums. Whenever a
+packet changes a node's ratio the new ratio is pushed onto a min heap and a
+max heap, so the top k nodes can be read off the heaps at any time. Old
+entries are left where they are and skipped when they come up, and the
+heaps are rebuilt once they hold too many of them, so an update costs
+O(log n).
+"""
+from heapq import heapify, heappop, heappush
+import graph_funcs as ext
+from packet_decode import DLT_EN10MB
+
+# Positions in the per node state lists
+INDEX, IN_BYTES, OUT_BYTES, IN_COUNT, OUT_COUNT, STAMP = range(6)
+
+
+class ExchangeRatioTracker:
+    """Running Information Exchange Ratios.
+
+    Ratios are worked out the same way as exchange_ratios in graph_funcs:
+    bytes in over 1 + bytes out, with nodes that haven't received anything
+    given 1 byte in. smallest(k) returns the same list as
+    exchange_ratios(G)[:k] for the graph built from the same packets.
+    """
+    def __init__(self):
+        self.nodes = {}  # Holds [index, in bytes, out bytes, in packets, out packets, stamp]
+        self._next_index = 0
+        self._next_stamp = 0
+        self._min_heap = []  # Holds (ratio, index, stamp, node)
+        self._max_heap = []  # Holds (-ratio, index, stamp, node)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, node):
+        return node in self.nodes
+
+    def add_packet(self, packet):
+        """Add a Scapy packet. Returns True if it was counted"""
+        fields = ext.packet_fields(packet)
+        if fields is None:
+            return False
+        self.add_fields(fields)
+        return True
+
+    def add_frame(self, frame, linktype=DLT_EN10MB):
+        """Add a raw frame. Returns True if it was counted"""
+        fields = ext.frame_fields(frame, linktype)
+        if fields is None:
+            return False
+        self.add_fields(fields)
+        return True
+
+    def add_fields(self, fields):
+        """Add a packet in the packet_fields format"""
+        self.add(fields[0], fields[1], fields[4])
+
+    def add(self, src, dst, w, count=1):
+        """Count count packets totalling w bytes sent from src to dst.
+        Negative values take traffic away again, e.g. when it expires out of
+        a window. Nodes left with no traffic either way are dropped"""
+        s = self._state(src)
+        s[OUT_BYTES] += w
+        s[OUT_COUNT] += count
+        d = self._state(dst)
+        d[IN_BYTES] += w
+        d[IN_COUNT] += count
+        self._changed(src, s)
+        if dst != src:
+            self._changed(dst, d)
+
+    def ratio(self, node):
+        """The current Information Exchange Ratio of node"""
+        return self._ratio(self.nodes[node])
+
+    def ratios(self):
+        """Every node's ratio, sorted like exchange_ratios"""
+        res = sorted(
+            (self._ratio(s), s[INDEX], node) for node, s in self.nodes.items())
+        return [(node, r) for r, i, node in res]
+
+    def smallest(self, k):
+        """The k nodes with the lowest ratios (the biggest senders)"""
+        return [(node, r) for r, node in self._top(self._min_heap, k)]
+
+    def largest(self, k):
+        """The k nodes with the highest ratios (the biggest receivers)"""
+        return [(node, -r) for r, node in self._top(self._max_heap, k)]
+
+    def _state(self, node):
+        s = self.nodes.get(node)
+        if s is None:
+            s = [self._next_index, 0, 0, 0, 0, -1]
+            self._next_index += 1
+            self.nodes[node] = s
+        return s
+
+    def _ratio(self, s):
+        in_w = s[IN_BYTES] if s[IN_COUNT] > 0 else 1
+        return in_w / (1 + s[OUT_BYTES])
+
+    def _changed(self, node, s):
+        if s[IN_COUNT] <= 0 and s[OUT_COUNT] <= 0:
+            # Any entries left on the heaps are skipped from now on
+            del self.nodes[node]
+            return
+        r = self._ratio(s)
+        s[STAMP] = stamp = self._next_stamp
+        self._next_stamp += 1
+        heappush(self._min_heap, (r, s[INDEX], stamp, node))
+        heappush(self._max_heap, (-r, s[INDEX], stamp, node))
+        limit = 4 * len(self.nodes) + 64
+        if len(self._min_heap) > limit or len(self._max_heap) > limit:
+            self._rebuild()
+
+    def _rebuild(self):
+        """Drop the old entries. Only happens after O(n) updates, so the
+        O(n) cost is spread over them"""
+        self._min_heap = []
+        self._max_heap = []
+        for node, s in self.nodes.items():
+            r = self._ratio(s)
+            self._min_heap.append((r, s[INDEX], s[STAMP], node))
+            self._max_heap.append((-r, s[INDEX], s[STAMP], node))
+        heapify(self._min_heap)
+        heapify(self._max_heap)
+
+    def _top(self, heap, k):
+        """Pop until k current entries are found, then put them back"""
+        found = []
+        while heap and len(found) < k:
+            entry = heappop(heap)
+            s = self.nodes.get(entry[3])
+            if s is not None and s[STAMP] == entry[2]:
+                found.append(entry)
+        for entry in found:
+            heappush(heap, entry)
+        return [(entry[0], entry[3]) for entry in found]
@@ -1,20 +1,243 @@
 # -*- coding: utf-8 -*-
+import gc
+import json
+import multiprocessing as mp
+import os
+from contextlib import contextmanager
+from heapq import nlargest
+from itertools import chain
+from operator import itemgetter
 import networkx as nx
-from scapy.all import rdpcap, IP, TCP, UDP, wrpcap
+import numpy as np
+from scipy import sparse
+from scapy.all import rdpcap, PcapReader, RawPcapReader, IP, TCP, UDP, wrpcap
+from scapy.all import conf
 from datetime import datetime
+from packet_decode import decode_frame, NEEDS_SCAPY, DLT_EN10MB
+from pcap_reader import MappedPcapRecords, read_header, split_records
 
+AGGREGATE_FLOW = "flow"  # one edge per (src MAC, dst MAC, sport, dport)
+AGGREGATE_PAIR = "pair"  # one edge per (src MAC, dst MAC)
+AGGREGATE_MODES = (AGGREGATE_FLOW, AGGREGATE_PAIR)
+CHUNKS_PER_PROCESS = 4  # smaller chunks keep every process busy until the end
 
-def file_to_graph(pcap_file):
-    packets = rdpcap(pcap_file)
-    new_graph = pcap_graph(packets)
+
+def file_to_graph(pcap_file, stream=True, fast=False, aggregate=None,
+                  processes=1, index=False):
+    """Create a packet graph from a Pcap file
+    Parameters:
+        pcap_file: The path to the capture to load
+        stream: Read the packets one at a time instead of loading the
+            whole capture into memory first (default True)
+        fast: Decode the headers from the raw bytes instead of having
+            Scapy dissect every packet (default False)
+        aggregate: None for one edge per packet (default), "flow" or "pair"
+            to merge packets into one edge per flow or per MAC pair
+        processes: parse the capture in this many processes, None for one
+            per CPU (default 1). Implies fast. Only classic pcap files can
+            be split up, pcapng files are still read by a single process
+        index: build the graph from the sidecar index next to the capture
+            (pcap_file + ".idx"), writing the index first if it is missing
+            or out of date (default False)"""
+    if index:
+        # Imported here as pcap_index itself builds on this module
+        from pcap_index import indexed_table
+        table, offsets = indexed_table(pcap_file)
+        return table.to_graph(aggregate)
+    if processes != 1:
+        if read_header(pcap_file) is not None:
+            return sharded_pcap_graph(pcap_file, processes, aggregate)
+        fast = True
+    if fast:
+        new_graph = nx.MultiDiGraph()
+        for frame, linktype, ts in raw_records(pcap_file):
+            if not aggregate:
+                ts = None
+            add_frame(new_graph, frame, linktype, ts, aggregate)
+        return new_graph
+    if not stream:
+        packets = rdpcap(pcap_file)
+        return pcap_graph(packets, aggregate=aggregate)
+    with PcapReader(pcap_file) as packets:
+        new_graph = pcap_graph(packets, aggregate=aggregate)
+    return new_graph
+
+
+def sharded_pcap_graph(pcap_file, processes=None, aggregate=None):
+    """Create a packet graph from a classic pcap file using a process pool.
+    The file is split into record aligned chunks, each process turns its
+    chunks into partial graphs (edge dicts, which are much cheaper to send
+    back than networkx graphs) and the parts are merged in file order, so
+    the result is the same graph file_to_graph(fast=True) builds.
+    Parameters:
+        pcap_file: The path to the capture to load
+        processes: the number of processes, None for one per CPU
+        aggregate: None, "flow" or "pair" (see file_to_graph)"""
+    if aggregate is not None and aggregate not in AGGREGATE_MODES:
+        raise ValueError("aggregate must be one of %s" % (AGGREGATE_MODES,))
+    header = read_header(pcap_file)
+    if header is None:
+        raise ValueError("%s is not a pcap file" % pcap_file)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    size = os.path.getsize(pcap_file)
+    chunks = split_records(pcap_file, processes * CHUNKS_PER_PROCESS, header)
+    tasks = [(pcap_file, header, start, end, aggregate) for start, end in chunks]
+    merged = {} if aggregate else []
+    pos = header.size
+    if len(tasks) > 1 and processes > 1:
+        # fork is quickest to start up where the platform has it
+        methods = mp.get_all_start_methods()
+        ctx = mp.get_context("fork" if "fork" in methods else None)
+        pool = ctx.Pool(min(processes, len(tasks)))
+        try:
+            for (start, end), (stop, part) in zip(
+                    chunks, pool.imap(_parse_chunk, tasks)):
+                # Once a chunk turns out to have started on a guessed
+                # boundary that isn't one, the rest are read again below
+                if start == pos:
+                    _merge_part(merged, part, aggregate)
+                    pos = stop
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.close()
+            pool.join()
+    if pos < size:
+        stop, part = _parse_chunk((pcap_file, header, pos, None, aggregate))
+        _merge_part(merged, part, aggregate)
+    new_graph = nx.MultiDiGraph()
+    if aggregate is None:
+        for fields in merged:
+            add_fields(new_graph, fields)
+        return new_graph
+    for (mac_src, mac_dst, key), d in merged.items():
+        ip_src, ip_dst, sport, dport, w, count, first_ts, last_ts = d
+        new_graph.add_edge(
+            mac_src,
+            mac_dst,
+            key=key,
+            ip_src=ip_src,
+            ip_dst=ip_dst,
+            sport=sport,
+            dport=dport,
+            weight=w,
+            count=count,
+            first_ts=first_ts,
+            last_ts=last_ts
+        )
     return new_graph
+
+
+def _parse_chunk(task):
+    """Process pool worker. Reads the records of one chunk and returns
+    where the chunk really stopped, along with either a list of packet
+    fields or, when aggregating, a dict of edge key to
+    [ip_src, ip_dst, sport, dport, weight, count, first_ts, last_ts]"""
+    pcap_file, header, start, end, aggregate = task
+    with MappedPcapRecords(pcap_file, header, start, end) as records:
+        if aggregate is None:
+            part = []
+            for frame, ts in records:
+                fields = frame_fields(frame, header.linktype)
+                if fields is not None:
+                    part.append(fields)
+        else:
+            part = _chunk_edges(records, header.linktype, aggregate)
+    return records.offset, part
+
+
+def _chunk_edges(records, linktype, aggregate):
+    """Aggregate a chunk's records into the edge dict _parse_chunk returns"""
+    part = {}
+    flows = aggregate == AGGREGATE_FLOW
+    for frame, ts in records:
+        fields = frame_fields(frame, linktype)
+        if fields is None:
+            continue
+        mac_src, mac_dst, ip_src, ip_dst, w, sport, dport = fields
+        if flows:
+            key = (mac_src, mac_dst, (sport, dport))
+        else:
+            key = (mac_src, mac_dst, 0)
+            sport = dport = None
+        d = part.get(key)
+        if d is None:
+            part[key] = [ip_src, ip_dst, sport, dport, w, 1, ts, ts]
+        else:
+            d[4] += w
+            d[5] += 1
+            if ts < d[6]:
+                d[6] = ts
+            if ts > d[7]:
+                d[7] = ts
+    return part
+
+
+def _merge_part(merged, part, aggregate):
+    """Fold a chunk's result into the results of the chunks before it.
+    Edges keep the addresses and ports of the earliest chunk they were in"""
+    if aggregate is None:
+        merged.extend(part)
+        return
+    for key, d in part.items():
+        m = merged.get(key)
+        if m is None:
+            merged[key] = d
+            continue
+        m[4] += d[4]
+        m[5] += d[5]
+        if d[6] < m[6]:
+            m[6] = d[6]
+        if d[7] > m[7]:
+            m[7] = d[7]
+
+
+def raw_records(pcap_file):
+    """Read the raw frames of a pcap or pcapng file without dissecting them
+    Parameters:
+        pcap_file: The path to the capture to read
+    Yields a (frame, link type, capture time) tuple per packet. Frames of
+    classic pcap files are memoryviews into a memory map of the file, which
+    are only good until the next frame is read"""
+    header = read_header(pcap_file)
+    if header is not None:
+        # Classic pcap, which can be read without copying or Scapy
+        linktype = header.linktype
+        with MappedPcapRecords(pcap_file, header) as records:
+            for frame, ts in records:
+                yield frame, linktype, ts
+        return
+    with RawPcapReader(pcap_file) as reader:
+        for frame, meta in reader:
+            # pcapng files record the link type with every packet
+            linktype = getattr(meta, "linktype", None)
+            if linktype is None:
+                linktype = reader.linktype
+            yield frame, linktype, _meta_time(reader, meta)
+
+
+def _meta_time(reader, meta):
+    """Capture time in seconds of a packet read by a RawPcapReader"""
+    if hasattr(meta, "tsresol"):
+        # pcapng
+        return ((meta.tshigh << 32) | meta.tslow) / meta.tsresol
+    if getattr(reader, "nano", False):
+        return meta.sec + meta.usec / 1e9
+    return meta.sec + meta.usec / 1e6
     
     
-def save_graph(G, out_file):
+def save_graph(G, out_file, binary=False):
     """Save a weighted edge list of a graph
     Parameters:
         G: a weighted graph to save
-        out_file: a path to save the file to"""
+        out_file: a path to save the file to
+        binary: write a binary snapshot that keeps every edge attribute
+            instead of a text edge list (default False)"""
+    if binary:
+        save_snapshot(G, out_file)
+        return
     now = datetime.now()
     dt_str = datetime.strftime(now, "%Y-%m-%d %H:%M")
     nx.write_weighted_edgelist(
@@ -22,6 +245,223 @@ def save_graph(G, out_file):
         out_file,
         comments="# Created from packet data %s" % dt_str
     )
+
+
+def load_graph(in_file):
+    """Load a graph written by save_graph, in either format. Text edge
+    lists only hold the weights and are loaded as a MultiDiGraph"""
+    with open(in_file, "rb") as f:
+        magic = f.read(4)
+    if magic == b"PK\x03\x04":
+        return load_snapshot(in_file)
+    return nx.read_weighted_edgelist(in_file, create_using=nx.MultiDiGraph)
+
+
+@contextmanager
+def _gc_paused():
+    """Turn the garbage collector off for the block. Snapshots make a dict
+    or tuple per edge, and the collector would scan the growing graph over
+    and over while they are made"""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+@_gc_paused()
+def save_snapshot(G, out_file):
+    """Save a graph and all of its attributes as a binary snapshot.
+    The snapshot is an uncompressed NumPy .npz archive. Nodes are stored
+    once in a table and edges refer to them by index. Every attribute is
+    stored as a typed column: integers and floats as int64/float64 arrays
+    with a mask for missing values, strings (such as IP addresses) as an
+    interned table plus int32 codes.
+    Parameters:
+        G: the graph to save
+        out_file: a path to save the file to"""
+    nodes = list(G.nodes())
+    index = {n: i for i, n in enumerate(nodes)}
+    multi = G.is_multigraph()
+    if G.is_directed():
+        # Walk the adjacency dicts directly, in the same order as G.edges,
+        # the edge view costs a function call per edge
+        if multi:
+            edges = [(u, v, k, d) for u, nbrs in G._succ.items()
+                     for v, keydict in nbrs.items()
+                     for k, d in keydict.items()]
+        else:
+            edges = [(u, v, None, d) for u, nbrs in G._succ.items()
+                     for v, d in nbrs.items()]
+    elif multi:
+        edges = [e for e in G.edges(keys=True, data=True)]
+    else:
+        edges = [(u, v, None, d) for u, v, d in G.edges(data=True)]
+    edge_attrs = _attribute_names(d for u, v, k, d in edges)
+    node_attrs = _attribute_names(d for n, d in G.nodes(data=True))
+    arrays = {}
+    meta = {
+        "directed": G.is_directed(),
+        "multigraph": multi,
+        "edge_columns": {},
+        "node_columns": {},
+        "keys": None
+    }
+    if not all(isinstance(n, str) for n in nodes):
+        raise ValueError("binary snapshots only support string node names")
+    arrays["nodes"] = np.array(nodes, dtype=str)
+    arrays["src"] = np.array([index[u] for u, v, k, d in edges], dtype=np.int32)
+    arrays["dst"] = np.array([index[v] for u, v, k, d in edges], dtype=np.int32)
+    columns = _columns([d for u, v, k, d in edges], edge_attrs)
+    for name in edge_attrs:
+        meta["edge_columns"][name] = _encode(arrays, "e_" + name, columns[name])
+    columns = _columns([d for n, d in G.nodes(data=True)], node_attrs)
+    for name in node_attrs:
+        meta["node_columns"][name] = _encode(arrays, "n_" + name, columns[name])
+    if multi:
+        keys = [k for u, v, k, d in edges]
+        if all(type(k) is int for k in keys):
+            meta["keys"] = "int"
+            arrays["keys"] = np.array(keys, dtype=np.int64)
+        elif all(k == (d.get("sport"), d.get("dport")) for u, v, k, d in edges):
+            # Flow aggregated graphs are keyed by their port pair
+            meta["keys"] = "ports"
+        else:
+            raise ValueError("binary snapshots only support int or port pair keys")
+    arrays["meta"] = np.array(json.dumps(meta))
+    with open(out_file, "wb") as f:
+        np.savez(f, **arrays)
+
+
+@_gc_paused()
+def load_snapshot(in_file):
+    """Load a graph saved by save_snapshot.
+    The columns are read back in bulk and directed graphs have their edges
+    put straight into the adjacency dicts. NetworkX still needs a dict of
+    attributes per edge, and building those is most of the load time: a
+    few seconds per million edges, so a 10M edge graph takes tens of
+    seconds"""
+    with np.load(in_file, allow_pickle=False) as data:
+        meta = json.loads(str(data["meta"]))
+        if meta["multigraph"]:
+            G = nx.MultiDiGraph() if meta["directed"] else nx.MultiGraph()
+        else:
+            G = nx.DiGraph() if meta["directed"] else nx.Graph()
+        nodes = data["nodes"].tolist()
+        node_columns = [
+            (name, _decode(data, "n_" + name, kind))
+            for name, kind in meta["node_columns"].items()
+        ]
+        G.add_nodes_from(_rows(nodes, node_columns))
+        src = [nodes[i] for i in data["src"].tolist()]
+        dst = [nodes[i] for i in data["dst"].tolist()]
+        edge_columns = [
+            (name, _decode(data, "e_" + name, kind))
+            for name, kind in meta["edge_columns"].items()
+        ]
+        attrs = [d for e, d in _rows(src, edge_columns)]
+        keys = None
+        if meta["keys"] == "int":
+            keys = data["keys"].tolist()
+        elif meta["keys"] == "ports":
+            keys = [(d.get("sport"), d.get("dport")) for d in attrs]
+        if G.is_directed():
+            _add_edges(G, src, dst, keys, attrs)
+        elif keys is not None:
+            G.add_edges_from(zip(src, dst, keys, attrs))
+        else:
+            G.add_edges_from(zip(src, dst, attrs))
+    return G
+
+
+def _add_edges(G, src, dst, keys, attrs):
+    """Add edges to a directed graph by writing its adjacency dicts
+    directly, skipping the checks add_edges_from makes for every edge.
+    Every node must already be in G and every edge must be new, as they
+    are when loading a snapshot"""
+    succ, pred = G._succ, G._pred
+    if keys is None:
+        for u, v, d in zip(src, dst, attrs):
+            succ[u][v] = d
+            pred[v][u] = d
+        return
+    for u, v, k, d in zip(src, dst, keys, attrs):
+        keydict = succ[u].get(v)
+        if keydict is None:
+            # Multigraphs share each key dict between succ and pred
+            keydict = succ[u][v] = pred[v][u] = {}
+        keydict[k] = d
+
+
+def _attribute_names(dicts):
+    """Every attribute name used in the dicts, in first seen order"""
+    return list(dict.fromkeys(chain.from_iterable(dicts)))
+
+
+def _columns(dicts, names):
+    """Turn a list of attribute dicts into {name: [values]}"""
+    columns = {}
+    for name in names:
+        try:
+            columns[name] = list(map(itemgetter(name), dicts))
+        except KeyError:
+            # Not every dict has this attribute
+            columns[name] = [d.get(name) for d in dicts]
+    return columns
+
+
+def _intern(values):
+    """Return the table of distinct strings and an int32 code per value,
+    -1 for None"""
+    table = {}
+    codes = [-1 if v is None else table.setdefault(v, len(table)) for v in values]
+    return np.array(list(table), dtype=str), np.array(codes, dtype=np.int32)
+
+
+def _encode(arrays, prefix, values):
+    """Store one attribute column in arrays, returns its kind"""
+    types = set(map(type, values))
+    missing = type(None) in types
+    types.discard(type(None))
+    if types <= {str}:
+        arrays[prefix], arrays[prefix + "_codes"] = _intern(values)
+        return "str"
+    if types == {bool}:
+        kind, dtype, fill = "bool", np.bool_, False
+    elif all(issubclass(t, (int, np.integer)) and t is not bool for t in types):
+        kind, dtype, fill = "int", np.int64, 0
+    elif all(issubclass(t, (int, float, np.integer, np.floating)) for t in types):
+        kind, dtype, fill = "float", np.float64, 0.0
+    else:
+        raise ValueError("%s holds values that can't be stored in a snapshot" % prefix[2:])
+    if missing:
+        arrays[prefix + "_mask"] = np.array([v is None for v in values], dtype=np.bool_)
+        values = [fill if v is None else v for v in values]
+    arrays[prefix] = np.array(values, dtype=dtype)
+    return kind
+
+
+def _decode(data, prefix, kind):
+    """Read one attribute column back as a list of Python values"""
+    if kind == "str":
+        table = data[prefix].tolist()
+        return [None if c < 0 else table[c] for c in data[prefix + "_codes"].tolist()]
+    values = data[prefix].tolist()
+    if prefix + "_mask" in data:
+        mask = data[prefix + "_mask"].tolist()
+        values = [None if m else v for v, m in zip(values, mask)]
+    return values
+
+
+def _rows(items, columns):
+    """Pair each item with a dict of its attributes from the columns"""
+    if len(columns) < 1:
+        return [(item, {}) for item in items]
+    names = [name for name, values in columns]
+    values = [values for name, values in columns]
+    return [(item, dict(zip(names, row))) for item, row in zip(items, zip(*values))]
     
     
 def save_packet(packet, out_file):
@@ -32,8 +472,14 @@ def save_packet(packet, out_file):
     wrpcap(out_file, packet, append=True)    
 
 
-def exchange_ratios(G):
-    """Calculate Information Exchange Ratio for every node"""
+def exchange_ratios(G, vectorized=True):
+    """Calculate Information Exchange Ratio for every node
+    Parameters:
+        G: a weighted packet graph
+        vectorized: compute the ratios from a sparse adjacency matrix
+            instead of walking the edges of every node (default True)"""
+    if vectorized:
+        return sparse_exchange_ratios(G)
     res = []
     for u in G.nodes.keys():
         out_edges = G.out_edges(u, data=True)
@@ -52,48 +498,304 @@ def exchange_ratios(G):
     return sorted(res, key=lambda x: x[1])
 
 
-def pcap_graph(packets):
-    net_graph = nx.MultiDiGraph()
-    for packet in packets:
-        if not packet.haslayer(IP):
-            # Not a packet we want to analyze.
-            continue
-        mac_src = packet.src # Sender MAC
-        mac_dst = packet.dst # Receiver MAC
-        ip_src = packet[IP].src # Sender I.P.
-        ip_dst = packet[IP].dst # Receiver I.P.
-        w = packet[IP].len # number of bytes in packet
-        if packet.haslayer(TCP):
-            sport=packet[TCP].sport # Sender port
-            dport=packet[TCP].dport # Receiver port
-        elif packet.haslayer(UDP):
-            sport=packet[UDP].sport # Sender port
-            dport=packet[UDP].dport # Receiver port
-        else:
-            # Not a packet we want to analyze.
-            continue
+def weighted_adjacency(G, weight="weight"):
+    """Build a sparse weighted adjacency matrix of a graph. Parallel edges
+    are summed into a single entry.
+    Returns a tuple of (nodes, A, in_degree) where A is a CSR matrix and
+    in_degree is the number of edges into each node, both in nodes order"""
+    nodes = list(G.nodes())
+    index = {n: i for i, n in enumerate(nodes)}
+    multi = G.is_multigraph()
+    rows = []
+    cols = []
+    counts = []
+    data = []
+    # Walk the adjacency once per node pair rather than once per edge
+    for u, nbrs in G.adj.items():
+        i = index[u]
+        for v, edges in nbrs.items():
+            rows.append(i)
+            cols.append(index[v])
+            if multi:
+                counts.append(len(edges))
+                data.append(sum([d.get(weight, 0) for d in edges.values()]))
+            else:
+                counts.append(1)
+                data.append(edges.get(weight, 0))
+    n = len(nodes)
+    rows = np.array(rows, dtype=np.int64)
+    cols = np.array(cols, dtype=np.int64)
+    data = np.array(data, dtype=np.float64)
+    A = sparse.coo_matrix((data, (rows, cols)), shape=(n, n)).tocsr()
+    in_degree = np.bincount(cols, weights=counts, minlength=n)
+    return nodes, A, in_degree
+
+
+def sparse_exchange_ratios(G):
+    """Calculate Information Exchange Ratio for every node with row and
+    column sums over the weighted adjacency matrix. Returns the same
+    sorted (node, IER) list as exchange_ratios"""
+    if G.number_of_nodes() < 1:
+        return []
+    nodes, A, in_degree = weighted_adjacency(G)
+    out_w = 1 + np.asarray(A.sum(axis=1)).ravel()
+    in_w = np.asarray(A.sum(axis=0)).ravel()
+    # Nodes nobody sends to are given an in weight of 1
+    in_w[in_degree == 0] = 1
+    ier = in_w / out_w
+    order = np.argsort(ier, kind="stable")
+    return [(nodes[i], r) for i, r in zip(order.tolist(), ier[order].tolist())]
+
+
+def packet_fields(packet):
+    """Pull the fields used by the packet graph out of a Scapy packet
+    Parameters:
+        packet: a Scapy packet
+    Returns a tuple of (mac_src, mac_dst, ip_src, ip_dst, length, sport, dport)
+    or None if the packet is not a TCP or UDP packet over IP"""
+    if not packet.haslayer(IP):
+        # Not a packet we want to analyze.
+        return None
+    mac_src = packet.src # Sender MAC
+    mac_dst = packet.dst # Receiver MAC
+    ip_src = packet[IP].src # Sender I.P.
+    ip_dst = packet[IP].dst # Receiver I.P.
+    w = packet[IP].len # number of bytes in packet
+    if packet.haslayer(TCP):
+        sport=packet[TCP].sport # Sender port
+        dport=packet[TCP].dport # Receiver port
+    elif packet.haslayer(UDP):
+        sport=packet[UDP].sport # Sender port
+        dport=packet[UDP].dport # Receiver port
+    else:
+        # Not a packet we want to analyze.
+        return None
+    return (str(mac_src), str(mac_dst), ip_src, ip_dst, w, sport, dport)
+
+
+def add_fields(G, fields, ts=None, aggregate=None):
+    """Add one packet's edge to a packet graph
+    Parameters:
+        G: the MultiDiGraph to update
+        fields: a tuple in the format returned by packet_fields
+        ts: the capture time of the packet, used by aggregated graphs
+        aggregate: None, "flow" or "pair" (see file_to_graph)
+
+    Aggregated edges keep the ip_src, ip_dst, sport and dport of the first
+    packet seen (ports are None for "pair" edges), the summed byte weight,
+    the packet count and the first_ts and last_ts capture times."""
+    mac_src, mac_dst, ip_src, ip_dst, w, sport, dport = fields
+    if aggregate is None:
         # Define an edge in the graph
-        net_graph.add_edge(
-            *(str(mac_src), str(mac_dst)),
+        G.add_edge(
+            mac_src,
+            mac_dst,
             ip_src=ip_src,
             ip_dst=ip_dst,
             sport=sport,
             dport=dport,
             weight=w
         )
+        return
+    if aggregate == AGGREGATE_FLOW:
+        key = (sport, dport)
+    elif aggregate == AGGREGATE_PAIR:
+        key = 0
+        sport = dport = None
+    else:
+        raise ValueError("aggregate must be one of %s" % (AGGREGATE_MODES,))
+    d = G.get_edge_data(mac_src, mac_dst, key)
+    if d is None:
+        G.add_edge(
+            mac_src,
+            mac_dst,
+            key=key,
+            ip_src=ip_src,
+            ip_dst=ip_dst,
+            sport=sport,
+            dport=dport,
+            weight=w,
+            count=1,
+            first_ts=ts,
+            last_ts=ts
+        )
+        return
+    d["weight"] += w
+    d["count"] += 1
+    if ts is not None:
+        if d["first_ts"] is None or ts < d["first_ts"]:
+            d["first_ts"] = ts
+        if d["last_ts"] is None or ts > d["last_ts"]:
+            d["last_ts"] = ts
+
+
+def add_packet(G, packet, aggregate=None, tracker=None):
+    """Add a single Scapy packet to a packet graph, and to an
+    ExchangeRatioTracker if one is given. Returns True if the packet was
+    added, False if it was skipped"""
+    fields = packet_fields(packet)
+    if fields is None:
+        return False
+    ts = float(packet.time) if aggregate else None
+    add_fields(G, fields, ts, aggregate)
+    if tracker is not None:
+        tracker.add_fields(fields)
+    return True
+
+
+def pcap_graph(packets, aggregate=None, tracker=None):
+    """Create a packet graph from any iterable of Scapy packets. The
+    iterable is consumed one packet at a time, so a PcapReader can be
+    passed in directly without holding the capture in memory.
+    Parameters:
+        packets: an iterable of Scapy packets
+        aggregate: None, "flow" or "pair" (see file_to_graph)
+        tracker: an ExchangeRatioTracker to feed the packets to as well"""
+    net_graph = nx.MultiDiGraph()
+    for packet in packets:
+        add_packet(net_graph, packet, aggregate, tracker)
+    return net_graph
+
+
+def scapy_packet(frame, linktype=DLT_EN10MB):
+    """Dissect a raw frame with Scapy the same way PcapReader would"""
+    # Scapy needs bytes, frames from a memory map are memoryviews
+    frame = bytes(frame)
+    try:
+        ll_cls = conf.l2types[linktype]
+    except KeyError:
+        ll_cls = conf.raw_layer
+    try:
+        return ll_cls(frame)
+    except Exception:
+        return conf.raw_layer(frame)
+
+
+def scapy_fields(frame, linktype=DLT_EN10MB):
+    """Dissect a raw frame with Scapy and return its packet_fields"""
+    return packet_fields(scapy_packet(frame, linktype))
+
+
+def frame_fields(frame, linktype=DLT_EN10MB):
+    """Return the packet_fields of a raw frame, using the fast decoder when
+    possible and Scapy otherwise"""
+    fields = decode_frame(frame, linktype)
+    if fields is NEEDS_SCAPY:
+        fields = scapy_fields(frame, linktype)
+    return fields
+
+
+def add_frame(G, frame, linktype=DLT_EN10MB, ts=None, aggregate=None,
+              tracker=None):
+    """Add a single raw frame to a packet graph, and to an
+    ExchangeRatioTracker if one is given. Returns True if the frame was
+    added, False if it was skipped"""
+    fields = frame_fields(frame, linktype)
+    if fields is None:
+        return False
+    add_fields(G, fields, ts, aggregate)
+    if tracker is not None:
+        tracker.add_fields(fields)
+    return True
+
+
+def raw_pcap_graph(records, linktype=DLT_EN10MB, aggregate=None, tracker=None):
+    """Create a packet graph from raw frame bytes. Gives the same graph as
+    pcap_graph but only uses Scapy for frames the fast decoder can't handle
+    Parameters:
+        records: an iterable of (frame bytes, capture time) pairs
+        linktype: the pcap link type of the frames (default Ethernet)
+        aggregate: None, "flow" or "pair" (see file_to_graph)
+        tracker: an ExchangeRatioTracker to feed the frames to as well"""
+    net_graph = nx.MultiDiGraph()
+    for frame, ts in records:
+        add_frame(net_graph, frame, linktype, ts, aggregate, tracker)
     return net_graph
 
 
-def protocol_subgraph(G, port):
-    """Return a subgraph of G, filtered by the destination port"""
+def protocol_subgraph(G, port, index=None):
+    """Return a subgraph of G, filtered by the destination port
+    Parameters:
+        G: a packet graph
+        port: the destination port to filter on
+        index: an optional index from port_index to look the edges up in
+            instead of scanning every edge of G"""
+    if index is not None:
+        return _edge_subgraph(index.get(port, []))
     proto_edges = [(u,v,d) for u,v,d in G.edges(data=True) if d["dport"] == port]
+    return _edge_subgraph(proto_edges)
+
+
+def _edge_subgraph(proto_edges):
     if len(proto_edges) < 1:
         return None
     sub_graph = nx.DiGraph()
     sub_graph.add_edges_from(proto_edges)
     return sub_graph
+
+
+def port_index(G, ports=None):
+    """Index the edges of a packet graph by destination port in one pass
+    Parameters:
+        G: a packet graph
+        ports: only index these ports (default None indexes every port)
+    Returns a dict of {dport: [(u, v, data), ...]}"""
+    if ports is not None:
+        ports = set(ports)
+    index = {}
+    for u, v, d in G.edges(data=True):
+        dport = d["dport"]
+        if ports is not None and dport not in ports:
+            continue
+        if dport in index:
+            index[dport].append((u, v, d))
+        else:
+            index[dport] = [(u, v, d)]
+    return index
+
+
+def protocol_subgraphs(G, ports=None, index=None):
+    """Return the protocol_subgraph of G for many ports at once
+    Parameters:
+        G: a packet graph
+        ports: the destination ports to extract (default None for every
+            port seen in G)
+        index: an existing port_index of G to reuse
+    Returns a dict of {port: subgraph}. Like protocol_subgraph, ports with
+    no traffic map to None"""
+    if index is None:
+        index = port_index(G, ports)
+    if ports is None:
+        ports = list(index.keys())
+    return {port: protocol_subgraph(G, port, index) for port in ports}
     
     
+def top_subgraph(G, n, weight="weight"):
+    """Reduce a packet graph to the n nodes that sent and received the most
+    bytes, with the parallel edges between each pair merged into a single
+    DiGraph edge holding their summed weight. Keeps drawing times bounded
+    on large captures
+    Parameters:
+        G: a packet graph
+        n: the number of nodes to keep
+        weight: the edge attribute to rank and sum by (default "weight")"""
+    strength = G.degree(weight=weight)
+    keep = {u for u, w in nlargest(n, strength, key=itemgetter(1))}
+    small = nx.DiGraph()
+    small.add_nodes_from(u for u in G if u in keep)
+    multi = G.is_multigraph()
+    for u in small:
+        for v, edges in G.adj[u].items():
+            if v not in keep:
+                continue
+            if multi:
+                w = sum([d.get(weight, 0) for d in edges.values()])
+            else:
+                w = edges.get(weight, 0)
+            small.add_edge(u, v, **{weight: w})
+    return small
+
+
 def label_set(G):
     """Create shortened label set (last 3 octets of MAC address)
     e.g. a1:b2:c3"""
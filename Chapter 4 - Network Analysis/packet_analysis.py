@@ -1,14 +1,97 @@
 # -*- coding: utf-8 -*-
 import os
+import threading
+import time
 import networkx as nx
 from optparse import OptionParser
 from scapy.all import sniff
 from matplotlib import pyplot as plt
 import graph_funcs as ext
+from window_graph import WindowedGraph
+from pcap_writer import RotatingPcapWriter
+from exchange_tracker import ExchangeRatioTracker
+from packet_table import cached_table
 
 network_graph = nx.MultiDiGraph()  # global network graph
 PACKETS = 10  # Default number of packets to capture before exiting
+FLUSH_SECONDS = 60  # Default seconds between graph snapshots in live mode
 save_raw = None
+raw_writer = None  # Holds the RotatingPcapWriter used to save packets in live mode
+graph_out = None  # Holds the path live graph snapshots are written to
+aggregate = None  # Holds the edge aggregation mode used in live mode
+flush_seconds = FLUSH_SECONDS
+graph_lock = threading.Lock()  # Held while the live graph is changed or saved
+window = None  # Holds the WindowedGraph when live mode is limited to a window
+binary_out = False  # Save binary graph snapshots instead of text edge lists
+tracker = None  # Holds the ExchangeRatioTracker when live mode reports top talkers
+top_k = 0  # Number of nodes to report at each live snapshot
+
+
+def snapshot_graph(G, out_file):
+    """Save the graph to a temporary file and move it into place so readers
+    never see a half written snapshot"""
+    tmp_file = out_file + ".tmp"
+    ext.save_graph(G, tmp_file, binary=binary_out)
+    os.replace(tmp_file, out_file)
+
+
+def draw_graph(G, node_size, out_file=None, top=None):
+    """Draw the graph in a window, or to out_file when one is given
+    Parameters:
+        G: the packet graph to draw
+        node_size: size of the node markers
+        out_file: an image file to save the drawing to instead
+        top: only draw the top nodes by bytes sent and received"""
+    if top:
+        G = ext.top_subgraph(G, top)
+    nx.draw_shell(G, node_size=node_size)
+    if out_file is None:
+        plt.show()
+    else:
+        plt.savefig(out_file)
+        plt.close()
+
+
+def print_top(tracker, k):
+    """Print the k nodes receiving the most and sending the most for the
+    traffic they exchange"""
+    print("Highest exchange ratios:")
+    for node, ier in tracker.largest(k):
+        print("  %s %.3f" % (node, ier))
+    print("Lowest exchange ratios:")
+    for node, ier in tracker.smallest(k):
+        print("  %s %.3f" % (node, ier))
+
+
+def live_packet(packet):
+    """sniff callback for live mode. Adds each packet to the global graph as
+    it arrives"""
+    if raw_writer is not None:
+        raw_writer.write(packet)
+    with graph_lock:
+        if window is not None:
+            window.add_packet(packet)
+        else:
+            ext.add_packet(network_graph, packet, aggregate, tracker)
+
+
+def flush_live():
+    """Expire the old traffic from the window and write a snapshot of the
+    live graph"""
+    with graph_lock:
+        if window is not None:
+            window.expire(time.time())
+        snapshot_graph(network_graph, graph_out)
+        if tracker is not None:
+            print_top(tracker, top_k)
+
+
+def flush_loop(stop):
+    """Call flush_live every flush_seconds until stop is set. Runs in its
+    own thread so snapshots keep coming when no packets arrive"""
+    while not stop.wait(flush_seconds):
+        flush_live()
+
 
 if __name__ == '__main__':
     parser = OptionParser()
@@ -23,8 +106,56 @@ if __name__ == '__main__':
         help="File to save the created graph to (required)")
     parser.add_option("-l", "--load", dest="load_file", default=None,
         help="Pcap file to load packets from")
+    parser.add_option("-f", "--fast", dest="fast", action="store_true",
+        default=False, help="Decode loaded packets without full Scapy dissection")
+    parser.add_option("-a", "--aggregate", dest="aggregate", default=None,
+        type="choice", choices=list(ext.AGGREGATE_MODES),
+        help="Merge packets into one edge per 'flow' or MAC 'pair' (default None)")
+    parser.add_option("-p", "--processes", dest="processes", default=1,
+        type="int", help="Number of processes used to load a pcap file, "
+        "0 for one per CPU (default 1)")
+    parser.add_option("-C", "--cache", dest="cache", action="store_true",
+        default=False, help="Keep a Parquet packet table next to the loaded "
+        "pcap file and build the graph from it, so the file is only parsed "
+        "once (needs pyarrow)")
+    parser.add_option("-x", "--index", dest="index", action="store_true",
+        default=False, help="Keep a sidecar index next to the loaded pcap "
+        "file and load the packets from it while it is up to date")
+    parser.add_option("-L", "--live", dest="live", action="store_true",
+        default=False, help="Update the graph as packets arrive instead of "
+        "after the capture ends. -c 0 captures until interrupted")
+    parser.add_option("-t", "--flush", dest="flush", default=FLUSH_SECONDS,
+        type="float", help="Seconds between graph snapshots in live mode "
+        "(default %d)" % FLUSH_SECONDS)
+    parser.add_option("-w", "--window", dest="window", default=None,
+        type="float", help="Only keep the last WINDOW seconds of traffic in "
+        "the live graph (default keep everything)")
+    parser.add_option("--rotate-size", dest="rotate_size", default=None,
+        type="float", help="Start a new raw packet file every ROTATE_SIZE MB "
+        "in live mode")
+    parser.add_option("--rotate-time", dest="rotate_time", default=None,
+        type="float", help="Start a new raw packet file every ROTATE_TIME "
+        "seconds in live mode")
+    parser.add_option("-b", "--binary", dest="binary", action="store_true",
+        default=False, help="Save the graph as a binary snapshot that keeps "
+        "all edge attributes (load with graph_funcs.load_graph)")
+    parser.add_option("-k", "--top", dest="top", default=0, type="int",
+        help="Print the TOP nodes with the highest and lowest exchange "
+        "ratios at every live snapshot (default 0, off)")
+    parser.add_option("-o", "--plot-out", dest="plot_file", default=None,
+        help="Save the graph drawing to this image file instead of showing "
+        "it, works without a display")
+    parser.add_option("-n", "--top-nodes", dest="top_nodes", default=None,
+        type="int", help="Only draw the TOP_NODES nodes with the most "
+        "traffic (default draw everything)")
+    parser.add_option("--no-draw", dest="draw", action="store_false",
+        default=True, help="Don't draw the graph, only save it")
     
     (opts, args) = parser.parse_args()
+    binary_out = opts.binary
+    if opts.plot_file is not None:
+        # Render without a display
+        plt.switch_backend("Agg")
     if opts.graph_file is None:
         print("-s required to save graph")
         exit()
@@ -37,20 +168,72 @@ if __name__ == '__main__':
             print("Loading Pcap file")
             if opts.raw_file is not None:
                 print("Packet saving turned off during file loading.")
-            network_graph = ext.file_to_graph(opts.load_file)
-            ext.save_graph(network_graph, opts.graph_file)
-            nx.draw_shell(network_graph, node_size=25)   
-            plt.show()
+            if opts.cache:
+                table = cached_table(opts.load_file)
+                network_graph = table.to_graph(opts.aggregate)
+            else:
+                network_graph = ext.file_to_graph(
+                    opts.load_file,
+                    fast=opts.fast,
+                    aggregate=opts.aggregate,
+                    processes=opts.processes or None,
+                    index=opts.index
+                )
+            ext.save_graph(network_graph, opts.graph_file, binary=binary_out)
+            if opts.draw:
+                draw_graph(network_graph, 25, opts.plot_file, opts.top_nodes)
         else:
             print("Could not locate file for parsing")
             exit()
+    elif opts.live:
+        c = int(opts.count)
+        if opts.raw_file is not None:
+            max_bytes = None
+            if opts.rotate_size is not None:
+                max_bytes = int(opts.rotate_size * 1000000)
+            raw_writer = RotatingPcapWriter(
+                opts.raw_file,
+                max_bytes=max_bytes,
+                max_seconds=opts.rotate_time
+            )
+        graph_out = opts.graph_file
+        flush_seconds = opts.flush
+        # Without aggregation the graph grows with every packet, so live
+        # mode keeps one edge per flow unless told otherwise
+        aggregate = opts.aggregate or ext.AGGREGATE_FLOW
+        if opts.top > 0:
+            top_k = opts.top
+            tracker = ExchangeRatioTracker()
+        if opts.window is not None:
+            window = WindowedGraph(opts.window, aggregate=aggregate,
+                                   tracker=tracker)
+            network_graph = window.graph
+        iface = None if opts.iface == "all" else opts.iface
+        print("Capturing, graph snapshots every %g seconds" % flush_seconds)
+        stop = threading.Event()
+        flusher = threading.Thread(target=flush_loop, args=(stop,),
+                                   daemon=True)
+        flusher.start()
+        try:
+            sniff(filter="ip", count=c, iface=iface, prn=live_packet,
+                  store=False)
+        finally:
+            stop.set()
+            flusher.join()
+        if raw_writer is not None:
+            raw_writer.close()
+        flush_live()
+        print("Captured graph has %d nodes and %d edges" % (
+            network_graph.number_of_nodes(),
+            network_graph.number_of_edges()
+        ))
     else:
         c = int(opts.count)
         # setup global raw save file if one is defined
         if opts.raw_file is not None:
             save_raw = opts.raw_file
         packets = sniff(filter="ip", count=c)
-        network_graph = ext.pcap_graph(packets)
-        ext.save_graph(network_graph, opts.graph_file)
-        nx.draw_shell(network_graph, node_size=100)   
-        plt.show()
\ No newline at end of file
+        network_graph = ext.pcap_graph(packets, aggregate=opts.aggregate)
+        ext.save_graph(network_graph, opts.graph_file, binary=binary_out)
+        if opts.draw:
+            draw_graph(network_graph, 100, opts.plot_file, opts.top_nodes)
\ No newline at end of file
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Pull the fields used by the packet graph straight out of the raw frame bytes.
+
+Scapy dissects every layer of every packet, which is far more work than the
+graph needs. The decoder here only reads the Ethernet, IPv4 and TCP/UDP
+headers. Frames it cannot be sure about (odd link types, tunnels, truncated
+headers) are flagged with NEEDS_SCAPY so the caller can fall back to a full
+Scapy dissection and still end up with exactly the same graph.
+"""
+from socket import inet_ntoa
+
+DLT_EN10MB = 1  # pcap link type for Ethernet
+
+NEEDS_SCAPY = object()  # returned when a frame must be dissected by Scapy
+
+ETH_IPV4 = 0x0800
+ETH_IPV6 = 0x86DD
+ETH_ARP = 0x0806
+ETH_VLAN = 0x8100
+
+PROTO_TCP = 6
+PROTO_UDP = 17
+# IP protocols Scapy can find another IP, TCP or UDP layer inside of
+# (ICMP errors, IP in IP, IPv6 in IP, GRE and AH)
+IP_ENCAPSULATING = frozenset((1, 4, 41, 47, 51))
+# UDP ports Scapy decodes as tunnels (L2TP, GRE in UDP and VXLAN)
+UDP_TUNNEL_PORTS = frozenset((1701, 4754, 4789, 4790, 6633, 8472, 48879))
+# IPv6 next headers that can't contain an IPv4 packet
+IPV6_TERMINAL = frozenset((PROTO_TCP, 58, 59))
+
+
+def decode_frame(frame, linktype=DLT_EN10MB):
+    """Decode a single captured frame
+    Parameters:
+        frame: the raw bytes of the frame
+        linktype: the pcap link type of the capture (default Ethernet)
+    Returns a tuple of (mac_src, mac_dst, ip_src, ip_dst, length, sport, dport),
+    None if the frame is not a TCP or UDP packet over IPv4 or NEEDS_SCAPY if
+    the frame has to be dissected by Scapy instead"""
+    if linktype != DLT_EN10MB:
+        return NEEDS_SCAPY
+    return decode_ether(frame)
+
+
+def decode_ether(frame):
+    """Decode an Ethernet frame. See decode_frame for the return values"""
+    caplen = len(frame)
+    if caplen < 34:
+        return NEEDS_SCAPY
+    ip = 14
+    eth_type = (frame[12] << 8) | frame[13]
+    if eth_type == ETH_VLAN:
+        # Skip over a single 802.1Q tag
+        eth_type = (frame[16] << 8) | frame[17]
+        ip = 18
+    if eth_type != ETH_IPV4:
+        if eth_type == ETH_ARP:
+            return None
+        if eth_type == ETH_IPV6:
+            return _check_ipv6(frame, ip)
+        return NEEDS_SCAPY
+    if caplen < ip + 20:
+        return NEEDS_SCAPY
+    ver_ihl = frame[ip]
+    ihl = (ver_ihl & 0x0F) << 2
+    if ver_ihl >> 4 != 4 or ihl < 20:
+        return NEEDS_SCAPY
+    if ((frame[ip + 6] & 0x1F) << 8) | frame[ip + 7]:
+        # Fragments past the first don't carry a transport header
+        return None
+    proto = frame[ip + 9]
+    if proto != PROTO_TCP and proto != PROTO_UDP:
+        if proto in IP_ENCAPSULATING:
+            return NEEDS_SCAPY
+        return None
+    length = (frame[ip + 2] << 8) | frame[ip + 3]
+    l4 = ip + ihl
+    # Scapy hands the transport layer at most `length` bytes of the packet
+    # and gives up on partial headers, so only decode complete ones.
+    available = min(length - ihl, caplen - l4)
+    if available < (20 if proto == PROTO_TCP else 8):
+        return NEEDS_SCAPY
+    sport = (frame[l4] << 8) | frame[l4 + 1]
+    dport = (frame[l4 + 2] << 8) | frame[l4 + 3]
+    if proto == PROTO_UDP and (
+            sport in UDP_TUNNEL_PORTS or dport in UDP_TUNNEL_PORTS):
+        return NEEDS_SCAPY
+    return (
+        frame[6:12].hex(":"),
+        frame[0:6].hex(":"),
+        inet_ntoa(frame[ip + 12:ip + 16]),
+        inet_ntoa(frame[ip + 16:ip + 20]),
+        length,
+        sport,
+        dport
+    )
+
+
+def ip_protocol(frame):
+    """The IP protocol number (6 for TCP, 17 for UDP) of an Ethernet frame
+    that decode_frame returned fields for"""
+    if ((frame[12] << 8) | frame[13]) == ETH_VLAN:
+        return frame[27]
+    return frame[23]
+
+
+def _check_ipv6(frame, ip):
+    """IPv6 packets aren't part of the graph unless they tunnel IPv4"""
+    if len(frame) < ip + 40:
+        return NEEDS_SCAPY
+    nh = frame[ip + 6]
+    if nh in IPV6_TERMINAL:
+        return None
+    if nh == PROTO_UDP and len(frame) >= ip + 44:
+        l4 = ip + 40
+        sport = (frame[l4] << 8) | frame[l4 + 1]
+        dport = (frame[l4 + 2] << 8) | frame[l4 + 3]
+        if sport not in UDP_TUNNEL_PORTS and dport not in UDP_TUNNEL_PORTS:
+            return None
+    return NEEDS_SCAPY
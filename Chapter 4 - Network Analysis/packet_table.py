@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+"""
+A columnar table of packets, to sit between the pcap file and the graph.
+
+Each packet becomes one row of typed NumPy columns (capture time, MACs, IPs,
+ports, length and protocol) instead of a networkx edge dict. MAC addresses
+are interned into a table and stored as int32 codes, IPv4 addresses as
+uint32. Graphs, port filters and per host statistics are then worked out
+with vectorized operations over the columns, and the table can be cached as
+a Parquet file so a capture only has to be parsed once.
+"""
+import os
+from socket import inet_aton, inet_ntoa
+import networkx as nx
+import numpy as np
+from scapy.all import PcapReader, TCP
+import graph_funcs as ext
+from packet_decode import decode_frame, ip_protocol, NEEDS_SCAPY, DLT_EN10MB
+
+PROTO_TCP = 6
+PROTO_UDP = 17
+
+COLUMNS = (
+    ("ts", np.float64),
+    ("mac_src", np.int32),
+    ("mac_dst", np.int32),
+    ("ip_src", np.uint32),
+    ("ip_dst", np.uint32),
+    ("sport", np.uint16),
+    ("dport", np.uint16),
+    ("length", np.uint32),
+    ("proto", np.uint8),
+)
+COLUMN_NAMES = tuple(name for name, dtype in COLUMNS)
+
+
+class PacketTable:
+    """Packets as columns.
+
+    macs is the table of MAC addresses, mac_src and mac_dst hold indexes
+    into it. The other columns are the ones named in COLUMNS. Rows are in
+    capture file order.
+    """
+    def __init__(self, macs, columns):
+        """Parameters:
+            macs: a sequence of MAC address strings
+            columns: a dict of every column in COLUMNS to a 1d array"""
+        self.macs = np.asarray(macs, dtype=str)
+        for name, dtype in COLUMNS:
+            setattr(self, name, np.asarray(columns[name], dtype=dtype))
+
+    def __len__(self):
+        return len(self.ts)
+
+    def columns(self):
+        """Return the columns as a dict of name to array"""
+        return {name: getattr(self, name) for name in COLUMN_NAMES}
+
+    def select(self, rows):
+        """Return a new table holding only the given rows (a boolean mask or
+        an array of row numbers). The MAC table is shared"""
+        return PacketTable(
+            self.macs,
+            {name: col[rows] for name, col in self.columns().items()}
+        )
+
+    def filter_port(self, port):
+        """Return the packets sent to a destination port, the same packets
+        graph_funcs.protocol_subgraph picks out"""
+        return self.select(self.dport == port)
+
+    def node_order(self):
+        """Codes of the MACs seen in the table, in the order a packet graph
+        built from it adds its nodes (first seen, sender before receiver)"""
+        both = np.empty(2 * len(self), dtype=np.int32)
+        both[0::2] = self.mac_src
+        both[1::2] = self.mac_dst
+        codes, first = np.unique(both, return_index=True)
+        return codes[np.argsort(first, kind="stable")]
+
+    def host_stats(self):
+        """Bytes and packets sent and received by every MAC
+        Returns a tuple of (nodes, stats) where nodes lists the MACs in
+        node_order and stats is a dict of out_bytes, in_bytes, out_packets
+        and in_packets arrays lined up with it"""
+        order = self.node_order()
+        n = len(self.macs)
+        length = self.length.astype(np.float64)
+        stats = {
+            "out_bytes": np.bincount(self.mac_src, weights=length, minlength=n),
+            "in_bytes": np.bincount(self.mac_dst, weights=length, minlength=n),
+            "out_packets": np.bincount(self.mac_src, minlength=n),
+            "in_packets": np.bincount(self.mac_dst, minlength=n),
+        }
+        for name in ("out_bytes", "in_bytes"):
+            stats[name] = stats[name].astype(np.int64)
+        return self.macs[order].tolist(), {k: v[order] for k, v in stats.items()}
+
+    def exchange_ratios(self):
+        """Information Exchange Ratio of every MAC, computed from the
+        columns. Returns the same sorted list as graph_funcs.exchange_ratios
+        run on to_graph()"""
+        nodes, stats = self.host_stats()
+        out_w = 1 + stats["out_bytes"]
+        in_w = np.where(stats["in_packets"] > 0, stats["in_bytes"], 1)
+        ier = in_w / out_w
+        order = np.argsort(ier, kind="stable")
+        return [(nodes[i], r) for i, r in zip(order.tolist(), ier[order].tolist())]
+
+    def to_graph(self, aggregate=None):
+        """Build the packet graph of the table, the same graph file_to_graph
+        builds from the capture
+        Parameters:
+            aggregate: None, "flow" or "pair" (see graph_funcs.file_to_graph)"""
+        G = nx.MultiDiGraph()
+        if len(self) == 0:
+            return G
+        macs = self.macs.tolist()
+        if aggregate is None:
+            src = [macs[i] for i in self.mac_src.tolist()]
+            dst = [macs[i] for i in self.mac_dst.tolist()]
+            attrs = zip(
+                _ip_strings(self.ip_src),
+                _ip_strings(self.ip_dst),
+                self.sport.tolist(),
+                self.dport.tolist(),
+                self.length.tolist()
+            )
+            G.add_edges_from(
+                (u, v, {"ip_src": a, "ip_dst": b, "sport": s, "dport": d,
+                        "weight": w})
+                for u, v, (a, b, s, d, w) in zip(src, dst, attrs)
+            )
+            return G
+        if aggregate == ext.AGGREGATE_FLOW:
+            first, group = _groups(
+                [self.mac_src, self.mac_dst, self.sport, self.dport])
+        elif aggregate == ext.AGGREGATE_PAIR:
+            first, group = _groups([self.mac_src, self.mac_dst])
+        else:
+            raise ValueError("aggregate must be one of %s" % (ext.AGGREGATE_MODES,))
+        n = len(first)
+        weight = np.bincount(
+            group, weights=self.length.astype(np.float64), minlength=n)
+        count = np.bincount(group, minlength=n)
+        # Sort the capture times by group so each group's are in one run
+        by_group = np.argsort(group, kind="stable")
+        starts = np.searchsorted(group[by_group], np.arange(n))
+        ts = self.ts[by_group]
+        first_ts = np.minimum.reduceat(ts, starts)
+        last_ts = np.maximum.reduceat(ts, starts)
+        src = [macs[i] for i in self.mac_src[first].tolist()]
+        dst = [macs[i] for i in self.mac_dst[first].tolist()]
+        if aggregate == ext.AGGREGATE_FLOW:
+            sports = self.sport[first].tolist()
+            dports = self.dport[first].tolist()
+            keys = list(zip(sports, dports))
+        else:
+            sports = dports = [None] * n
+            keys = [0] * n
+        attrs = zip(
+            _ip_strings(self.ip_src[first]),
+            _ip_strings(self.ip_dst[first]),
+            sports,
+            dports,
+            weight.astype(np.int64).tolist(),
+            count.tolist(),
+            first_ts.tolist(),
+            last_ts.tolist()
+        )
+        G.add_edges_from(
+            (u, v, k, {"ip_src": a, "ip_dst": b, "sport": s, "dport": d,
+                       "weight": w, "count": c, "first_ts": t0, "last_ts": t1})
+            for u, v, k, (a, b, s, d, w, c, t0, t1) in zip(src, dst, keys, attrs)
+        )
+        return G
+
+    def save_parquet(self, out_file):
+        """Save the table as a Parquet file. MACs are stored as a dictionary
+        encoded column. Needs pyarrow"""
+        pa, pq = _pyarrow()
+        macs = pa.array(self.macs.tolist(), type=pa.string())
+        arrays = []
+        for name in COLUMN_NAMES:
+            col = getattr(self, name)
+            if name in ("mac_src", "mac_dst"):
+                arrays.append(pa.DictionaryArray.from_arrays(col, macs))
+            else:
+                arrays.append(pa.array(col))
+        pq.write_table(pa.table(arrays, names=list(COLUMN_NAMES)), out_file)
+
+    @classmethod
+    def load_parquet(cls, in_file):
+        """Load a table saved by save_parquet. Needs pyarrow"""
+        pa, pq = _pyarrow()
+        table = pq.read_table(in_file)
+        columns = {}
+        macs = []
+        index = {}
+        for name in COLUMN_NAMES:
+            col = table.column(name)
+            if name in ("mac_src", "mac_dst"):
+                # Each chunk can carry its own dictionary, so map them all
+                # onto one MAC table
+                codes = []
+                for chunk in col.chunks:
+                    lookup = []
+                    for mac in chunk.dictionary.to_pylist():
+                        if mac not in index:
+                            index[mac] = len(macs)
+                            macs.append(mac)
+                        lookup.append(index[mac])
+                    lookup = np.array(lookup, dtype=np.int32)
+                    codes.append(lookup[chunk.indices.to_numpy()])
+                columns[name] = (np.concatenate(codes) if codes
+                                 else np.zeros(0, dtype=np.int32))
+            else:
+                columns[name] = col.to_numpy()
+        return cls(macs, columns)
+
+    @classmethod
+    def from_pcap(cls, pcap_file, fast=True):
+        """Parse a pcap or pcapng file into a table
+        Parameters:
+            pcap_file: The path to the capture to load
+            fast: decode the headers from the raw bytes instead of having
+                Scapy dissect every packet (default True)"""
+        builder = TableBuilder()
+        if fast:
+            for frame, linktype, ts in ext.raw_records(pcap_file):
+                builder.add_frame(frame, linktype, ts)
+        else:
+            with PcapReader(pcap_file) as packets:
+                for packet in packets:
+                    builder.add_packet(packet)
+        return builder.table()
+
+    @classmethod
+    def from_packets(cls, packets):
+        """Build a table from any iterable of Scapy packets"""
+        builder = TableBuilder()
+        for packet in packets:
+            builder.add_packet(packet)
+        return builder.table()
+
+
+class TableBuilder:
+    """Collects packets one at a time and turns them into a PacketTable"""
+    def __init__(self):
+        self._macs = {}
+        self._ips = {}
+        self._rows = {name: [] for name in COLUMN_NAMES}
+
+    def add_packet(self, packet, ts=None):
+        """Add a Scapy packet. Returns True if it was added"""
+        fields = ext.packet_fields(packet)
+        if fields is None:
+            return False
+        if ts is None:
+            ts = float(packet.time)
+        proto = PROTO_TCP if packet.haslayer(TCP) else PROTO_UDP
+        self.add_fields(fields, ts, proto)
+        return True
+
+    def add_frame(self, frame, linktype=DLT_EN10MB, ts=0.0):
+        """Add a raw frame captured at ts. Returns True if it was added"""
+        fields = decode_frame(frame, linktype)
+        if fields is NEEDS_SCAPY:
+            return self.add_packet(ext.scapy_packet(frame, linktype), ts)
+        if fields is None:
+            return False
+        self.add_fields(fields, ts, ip_protocol(frame))
+        return True
+
+    def add_fields(self, fields, ts, proto):
+        """Add a packet in the packet_fields format"""
+        mac_src, mac_dst, ip_src, ip_dst, w, sport, dport = fields
+        rows = self._rows
+        rows["ts"].append(ts)
+        rows["mac_src"].append(self._mac(mac_src))
+        rows["mac_dst"].append(self._mac(mac_dst))
+        rows["ip_src"].append(self._ip(ip_src))
+        rows["ip_dst"].append(self._ip(ip_dst))
+        rows["sport"].append(sport)
+        rows["dport"].append(dport)
+        rows["length"].append(w)
+        rows["proto"].append(proto)
+
+    def table(self):
+        """Return the packets added so far as a PacketTable"""
+        return PacketTable(list(self._macs), self._rows)
+
+    def _mac(self, mac):
+        code = self._macs.get(mac)
+        if code is None:
+            code = self._macs[mac] = len(self._macs)
+        return code
+
+    def _ip(self, ip):
+        value = self._ips.get(ip)
+        if value is None:
+            value = self._ips[ip] = int.from_bytes(inet_aton(ip), "big")
+        return value
+
+
+def cached_table(pcap_file, cache_file=None, fast=True):
+    """Load the PacketTable of a capture from its Parquet cache, parsing the
+    capture and writing the cache first if it is missing or older than the
+    capture
+    Parameters:
+        pcap_file: The path to the capture
+        cache_file: where to keep the cache (default pcap_file + ".parquet")
+        fast: see PacketTable.from_pcap"""
+    if cache_file is None:
+        cache_file = pcap_file + ".parquet"
+    if (os.path.exists(cache_file) and
+            os.path.getmtime(cache_file) >= os.path.getmtime(pcap_file)):
+        return PacketTable.load_parquet(cache_file)
+    table = PacketTable.from_pcap(pcap_file, fast=fast)
+    table.save_parquet(cache_file)
+    return table
+
+
+def _ip_strings(ips):
+    """Dotted quad strings for an array of uint32 IPv4 addresses"""
+    values, inverse = np.unique(ips, return_inverse=True)
+    names = [inet_ntoa(int(v).to_bytes(4, "big")) for v in values.tolist()]
+    return [names[i] for i in inverse.ravel().tolist()]
+
+
+def _groups(columns):
+    """Group rows that are equal in every column.
+    Returns a tuple of (first, group): the first row of every group, in the
+    order the groups first appear, and the group number of every row"""
+    n = len(columns[0])
+    # lexsort is stable, so the first row of each run is the group's first
+    order = np.lexsort(columns[::-1])
+    change = np.zeros(n, dtype=bool)
+    change[0] = True
+    for col in columns:
+        s = col[order]
+        change[1:] |= s[1:] != s[:-1]
+    sorted_group = np.cumsum(change) - 1
+    first = order[change]
+    # Number the groups by first appearance instead of sort order
+    rank = np.argsort(first, kind="stable")
+    renumber = np.empty_like(rank)
+    renumber[rank] = np.arange(len(rank))
+    group = np.empty(n, dtype=np.int64)
+    group[order] = renumber[sorted_group]
+    return first[rank], group
+
+
+def _pyarrow():
+    """Import pyarrow only when a Parquet file is used"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("Parquet caching needs pyarrow (pip install pyarrow)")
+    return pa, pq
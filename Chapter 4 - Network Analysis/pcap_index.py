@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Sidecar index files for captures that are loaded over and over.
+
+The first load of a capture writes capture.pcap.idx next to it: a NumPy .npz
+archive holding the PacketTable columns of every packet the graph uses
+(capture time, MACs, IPs, ports, length and protocol) and the offset of each
+packet's record in the capture. The index remembers the size and mtime of
+the capture it was made from, and is only used while both still match, so
+later loads can skip dissecting the packets altogether.
+"""
+import json
+import os
+from zipfile import BadZipFile
+import numpy as np
+import graph_funcs as ext
+from packet_table import PacketTable, TableBuilder, COLUMN_NAMES
+from pcap_reader import MappedPcapRecords, read_header
+
+INDEX_VERSION = 1
+
+
+def index_path(pcap_file):
+    """The default sidecar index path of a capture"""
+    return pcap_file + ".idx"
+
+
+def indexed_table(pcap_file, index_file=None):
+    """Return the PacketTable and record offsets of a capture, from its
+    index if it is still valid, otherwise by parsing the capture and
+    writing a new index
+    Parameters:
+        pcap_file: The path to the capture
+        index_file: where to keep the index (default pcap_file + ".idx")"""
+    if index_file is None:
+        index_file = index_path(pcap_file)
+    res = read_index(pcap_file, index_file)
+    if res is not None:
+        return res
+    table, offsets = build_index(pcap_file)
+    try:
+        write_index(pcap_file, table, offsets, index_file)
+    except OSError:
+        # The index only saves time, a capture in a read only folder can
+        # still be loaded
+        pass
+    return table, offsets
+
+
+def build_index(pcap_file):
+    """Parse a capture into a PacketTable and the record offset of every
+    row. Offsets are -1 for pcapng and compressed captures, which can't be
+    read record by record"""
+    builder = TableBuilder()
+    offsets = []
+    for offset, frame, linktype, ts in _offset_records(pcap_file):
+        if builder.add_frame(frame, linktype, ts):
+            offsets.append(offset)
+    return builder.table(), np.array(offsets, dtype=np.int64)
+
+
+def write_index(pcap_file, table, offsets, index_file=None):
+    """Save a capture's PacketTable and record offsets as its index"""
+    if index_file is None:
+        index_file = index_path(pcap_file)
+    st = os.stat(pcap_file)
+    meta = {
+        "version": INDEX_VERSION,
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns
+    }
+    arrays = table.columns()
+    arrays["macs"] = table.macs
+    arrays["offsets"] = offsets
+    arrays["meta"] = np.array(json.dumps(meta))
+    # Write to a temporary file first so a crash never leaves half an index
+    tmp_file = index_file + ".tmp"
+    with open(tmp_file, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_file, index_file)
+
+
+def read_index(pcap_file, index_file=None):
+    """Load a capture's index
+    Returns a tuple of (PacketTable, offsets), or None if there is no index
+    or it doesn't match the capture any more"""
+    if index_file is None:
+        index_file = index_path(pcap_file)
+    try:
+        data = np.load(index_file, allow_pickle=False)
+    except (OSError, ValueError, BadZipFile):
+        return None
+    with data:
+        try:
+            meta = json.loads(str(data["meta"]))
+        except (KeyError, ValueError):
+            return None
+        st = os.stat(pcap_file)
+        if (meta.get("version") != INDEX_VERSION or
+                meta.get("size") != st.st_size or
+                meta.get("mtime_ns") != st.st_mtime_ns):
+            return None
+        columns = {name: data[name] for name in COLUMN_NAMES}
+        return PacketTable(data["macs"], columns), data["offsets"]
+
+
+def _offset_records(pcap_file):
+    """Like graph_funcs.raw_records, with the record offset in front"""
+    header = read_header(pcap_file)
+    if header is None:
+        for frame, linktype, ts in ext.raw_records(pcap_file):
+            yield -1, frame, linktype, ts
+        return
+    linktype = header.linktype
+    with MappedPcapRecords(pcap_file, header) as records:
+        offset = records.offset
+        for frame, ts in records:
+            yield offset, frame, linktype, ts
+            offset = records.offset
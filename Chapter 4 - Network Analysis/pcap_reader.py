@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Read classic pcap files in pieces so they can be parsed in parallel.
+
+A pcap file is a 24 byte global header followed by records, each one a 16
+byte header (seconds, fraction of a second, captured length, wire length)
+and the captured bytes. There is no index, so the only sure way to find a
+record boundary is to walk the file from the start. split_records guesses a
+boundary near each split point instead, by looking for a run of record
+headers that chain together. A guess is confirmed when the chunk before it
+has been read: a chunk that doesn't stop exactly where the next one starts
+means the guess was wrong, and the caller has to carry on from where the
+chunk really stopped.
+
+MappedPcapRecords reads the records, or the records of one chunk, from a
+memory map of the file and hands out memoryview slices of it, so no bytes
+are copied per packet.
+"""
+import mmap
+import os
+import struct
+from collections import namedtuple
+
+MTU = 65535  # Scapy cuts frames down to this size when reading them
+
+PCAP_MAGIC = {
+    b"\xa1\xb2\xc3\xd4": (">", False),
+    b"\xd4\xc3\xb2\xa1": ("<", False),
+    b"\xa1\xb2\x3c\x4d": (">", True),  # nanosecond timestamps
+    b"\x4d\x3c\xb2\xa1": ("<", True),
+}
+
+# Byte order and timestamp resolution of a pcap file, plus the values from
+# its global header. size is the offset of the first record
+PcapHeader = namedtuple(
+    "PcapHeader", ["endian", "nano", "snaplen", "linktype", "size"])
+
+
+def read_header(pcap_file):
+    """Read the global header of a pcap file
+    Parameters:
+        pcap_file: the path to the capture
+    Returns a PcapHeader, or None if the file isn't a classic pcap file
+    (pcapng and compressed captures aren't)"""
+    with open(pcap_file, "rb") as f:
+        hdr = f.read(24)
+    if len(hdr) < 24 or hdr[:4] not in PCAP_MAGIC:
+        return None
+    endian, nano = PCAP_MAGIC[hdr[:4]]
+    snaplen, linktype = struct.unpack(endian + "II", hdr[16:24])
+    return PcapHeader(endian, nano, snaplen, linktype, 24)
+
+
+class MappedPcapRecords:
+    """Iterate over the records of a pcap file, or of a byte range of it,
+    without copying them.
+
+    Yields (frame, capture time) pairs, read the same way as Scapy's
+    RawPcapReader. Records are read from `start` (the first record when
+    None) until one starts at or past `end` (the end of the file when None).
+    Once the iteration is over, offset holds where the next record starts.
+
+    The file is memory mapped and every frame is a memoryview into the map.
+    The views are only good until close() is called (or the with block
+    ends), so anything that has to outlive the iteration must be copied
+    with bytes(frame).
+    """
+    def __init__(self, pcap_file, header=None, start=None, end=None):
+        """Parameters:
+            pcap_file: the path to the capture
+            header: the file's PcapHeader (read from the file when None)
+            start: offset of the first record to read
+            end: stop at the first record starting at or after this offset"""
+        if header is None:
+            header = read_header(pcap_file)
+            if header is None:
+                raise ValueError("%s is not a pcap file" % pcap_file)
+        self.header = header
+        self.offset = header.size if start is None else start
+        self.end = end
+        with open(pcap_file, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Unmap the file"""
+        self._view.release()
+        try:
+            self._map.close()
+        except BufferError:
+            # Frames are still referenced somewhere. The map is closed
+            # when the last of them goes away
+            pass
+
+    def __iter__(self):
+        data = self._map
+        view = self._view
+        unpack = struct.Struct(self.header.endian + "IIII").unpack_from
+        scale = 1e9 if self.header.nano else 1e6
+        size = len(data)
+        end = size if self.end is None else min(self.end, size)
+        i = self.offset
+        while i < end and i + 16 <= size:
+            sec, frac, caplen, wirelen = unpack(data, i)
+            frame = view[i + 16:i + 16 + min(caplen, MTU)]
+            i += 16 + caplen
+            self.offset = i
+            yield frame, sec + frac / scale
+
+
+def find_record(data, offset, header, depth=8):
+    """Find the first offset at or after offset where a record seems to
+    start: `depth` record headers in a row (or every one up to the end of the
+    data) have sensible values and each follows straight after the last.
+    Parameters:
+        data: the contents of the pcap file, e.g. an mmap
+        offset: where to start looking
+        header: the file's PcapHeader
+        depth: number of records that have to chain together
+    Returns the offset, or len(data) if no record was found"""
+    size = len(data)
+    unpack = struct.Struct(header.endian + "IIII").unpack_from
+    frac_limit = 1000000000 if header.nano else 1000000
+    max_caplen = max(header.snaplen, MTU)
+    for pos in range(offset, size):
+        p = pos
+        for _ in range(depth):
+            if p == size:
+                return pos
+            if p + 16 > size:
+                break
+            sec, frac, caplen, wirelen = unpack(data, p)
+            if frac >= frac_limit or caplen > max_caplen or caplen > wirelen:
+                break
+            p += 16 + caplen
+        else:
+            return pos
+    return size
+
+
+def split_records(pcap_file, parts, header=None):
+    """Split a pcap file into roughly equal byte ranges that (most likely)
+    start on a record boundary. See the module docstring for how to check
+    the guesses.
+    Parameters:
+        pcap_file: the path to the capture
+        parts: the number of ranges wanted
+        header: the file's PcapHeader (read from the file when None)
+    Returns a list of (start, end) offsets"""
+    if header is None:
+        header = read_header(pcap_file)
+        if header is None:
+            raise ValueError("%s is not a pcap file" % pcap_file)
+    size = os.path.getsize(pcap_file)
+    bounds = [header.size]
+    if parts > 1 and size > header.size:
+        with open(pcap_file, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for i in range(1, parts):
+                    nominal = header.size + (size - header.size) * i // parts
+                    pos = find_record(data, max(nominal, bounds[-1] + 1), header)
+                    if pos < size:
+                        bounds.append(pos)
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
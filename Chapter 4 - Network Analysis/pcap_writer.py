@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Long lived pcap writer for saving packets during a live capture.
+
+save_packet in graph_funcs reopens the output file for every packet. The
+writer here keeps the file open, collects packets into batches on the
+capture side and hands each batch to a background thread, which turns the
+packets into pcap records and writes them out. The capture callback only
+appends to a list, so slow disks don't hold up the capture. Output files
+can be rotated by size or by age.
+"""
+import os
+import struct
+import threading
+import time
+from queue import Queue, Empty
+from scapy.all import conf
+from packet_decode import DLT_EN10MB
+
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_HEADER = struct.Struct("<IHHiIII")
+RECORD_HEADER = struct.Struct("<IIII")
+
+
+class RotatingPcapWriter:
+    """Buffered pcap writer that rotates its output files.
+
+    With no rotation limits everything is appended to out_file. With
+    max_bytes or max_seconds set, packets go to a series of files named
+    after out_file with the time the file was started and a counter, e.g.
+    capture_20230927-101500_0.pcap
+    """
+    def __init__(self, out_file, linktype=None, max_bytes=None,
+                 max_seconds=None, flush_packets=1000, flush_seconds=1.0,
+                 snaplen=65535, max_batches=256):
+        """Parameters:
+            out_file: the pcap file (or file name pattern when rotating)
+            linktype: pcap link type of the packets (default taken from the
+                first Scapy packet, or Ethernet for raw frames)
+            max_bytes: start a new file once a file reaches this size
+            max_seconds: start a new file once a file is this many seconds old
+            flush_packets: packets per batch handed to the writer thread
+            flush_seconds: longest time a packet waits before it is written
+            snaplen: snapshot length recorded in the file headers
+            max_batches: batches allowed to queue up before write blocks"""
+        self.out_file = out_file
+        self.linktype = linktype
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.flush_packets = flush_packets
+        self.flush_seconds = flush_seconds
+        self.snaplen = snaplen
+        self.files = []  # Holds the paths of every file written to
+        self._batch = []
+        self._batch_started = time.time()
+        self._lock = threading.Lock()
+        self._queue = Queue(maxsize=max_batches)
+        self._error = None
+        self._f = None
+        self._file_bytes = 0
+        self._file_started = 0
+        self._file_number = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, packet):
+        """Queue a Scapy packet to be saved"""
+        self._add(packet)
+
+    def write_frame(self, frame, ts, wirelen=None):
+        """Queue raw frame bytes captured at ts to be saved"""
+        self._add((frame, ts, wirelen))
+
+    def flush(self):
+        """Hand the packets collected so far to the writer thread"""
+        with self._lock:
+            batch = self._take()
+        if batch:
+            self._queue.put(batch)
+
+    def close(self):
+        """Write out every queued packet and close the current file"""
+        if self._closed:
+            return
+        self._closed = True
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def _add(self, item):
+        if self._error is not None:
+            raise self._error
+        if self._closed:
+            raise ValueError("write to a closed RotatingPcapWriter")
+        with self._lock:
+            self._batch.append(item)
+            if (len(self._batch) < self.flush_packets and
+                    time.time() - self._batch_started < self.flush_seconds):
+                return
+            batch = self._take()
+        self._queue.put(batch)
+
+    def _take(self):
+        """Swap out the current batch. Must hold self._lock"""
+        batch = self._batch
+        self._batch = []
+        self._batch_started = time.time()
+        return batch
+
+    def _run(self):
+        """Writer thread. Writes batches as they arrive and picks up
+        partial batches itself when the capture goes quiet"""
+        try:
+            while True:
+                try:
+                    batch = self._queue.get(timeout=self.flush_seconds)
+                except Empty:
+                    with self._lock:
+                        if time.time() - self._batch_started < self.flush_seconds:
+                            continue
+                        batch = self._take()
+                if batch is None:
+                    break
+                if batch:
+                    self._write_batch(batch)
+        except Exception as e:
+            self._error = e
+            # Keep draining so writers blocked on a full queue are released
+            while self._queue.get() is not None:
+                pass
+        finally:
+            if self._f is not None:
+                self._f.close()
+                self._f = None
+
+    def _write_batch(self, batch):
+        for item in batch:
+            if isinstance(item, tuple):
+                frame, ts, wirelen = item
+                if self.linktype is None:
+                    self.linktype = DLT_EN10MB
+            else:
+                frame = bytes(item)
+                ts = float(item.time)
+                wirelen = getattr(item, "wirelen", None)
+                if self.linktype is None:
+                    self.linktype = conf.l2types.layer2num.get(
+                        item.__class__, DLT_EN10MB)
+            self._rotate(ts)
+            sec = int(ts)
+            usec = int(round((ts - sec) * 1e6))
+            if usec >= 1000000:
+                sec += 1
+                usec -= 1000000
+            caplen = len(frame)
+            self._f.write(RECORD_HEADER.pack(sec, usec, caplen, wirelen or caplen))
+            self._f.write(frame)
+            self._file_bytes += RECORD_HEADER.size + caplen
+        self._f.flush()
+
+    def _rotate(self, ts):
+        """Open the first file, or the next one when a limit is reached"""
+        if self._f is not None:
+            too_big = (self.max_bytes is not None and
+                       self._file_bytes >= self.max_bytes)
+            too_old = (self.max_seconds is not None and
+                       ts - self._file_started >= self.max_seconds)
+            if not too_big and not too_old:
+                return
+            self._f.close()
+        rotating = self.max_bytes is not None or self.max_seconds is not None
+        if rotating:
+            root, ext = os.path.splitext(self.out_file)
+            stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(ts))
+            path = "%s_%s_%d%s" % (root, stamp, self._file_number, ext or ".pcap")
+            self._file_number += 1
+            self._f = open(path, "wb")
+        else:
+            # A single file is appended to, just like save_packet
+            path = self.out_file
+            self._f = open(path, "ab")
+        self.files.append(path)
+        self._file_started = ts
+        self._file_bytes = self._f.tell()
+        if self._file_bytes == 0:
+            self._f.write(PCAP_HEADER.pack(
+                PCAP_MAGIC, 2, 4, 0, 0, self.snaplen, self.linktype))
+            self._file_bytes = PCAP_HEADER.size
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+A packet graph that only covers the last few minutes of traffic.
+
+Packets are counted into time buckets `resolution` seconds wide. Each bucket
+remembers how many bytes and packets it added to every edge, so when a
+bucket falls out of the window its contribution is subtracted again and
+edges or nodes left with no traffic are removed. Every packet is added once
+and expired once, which keeps the cost per packet amortized O(1).
+"""
+from collections import deque
+from math import floor
+import networkx as nx
+import graph_funcs as ext
+from packet_decode import DLT_EN10MB
+
+
+class WindowedGraph:
+    """Sliding window packet graph.
+
+    The graph attribute is a MultiDiGraph with one edge per flow (or per MAC
+    pair) seen inside the window, in the same format as the aggregated
+    graphs from graph_funcs, so exchange_ratios and protocol_subgraph can
+    be run on it directly. Edges hold the window's summed byte weight,
+    packet count and the last_ts the flow was seen. Nodes hold their current
+    in_weight and out_weight in bytes.
+    """
+    def __init__(self, window=300, resolution=1, aggregate=ext.AGGREGATE_FLOW,
+                 tracker=None):
+        """Parameters:
+            window: number of seconds of traffic to keep (default 300)
+            resolution: width in seconds of the expiry buckets (default 1)
+            aggregate: "flow" or "pair" (see graph_funcs.file_to_graph)
+            tracker: an ExchangeRatioTracker to keep in step with the
+                window (traffic is taken off it again as it expires)"""
+        if aggregate not in ext.AGGREGATE_MODES:
+            raise ValueError("aggregate must be one of %s" % (ext.AGGREGATE_MODES,))
+        self.window = window
+        self.resolution = resolution
+        self.aggregate = aggregate
+        self.tracker = tracker
+        self.graph = nx.MultiDiGraph()
+        self.buckets = deque()  # Holds (bucket number, {edge: [bytes, packets]})
+        self.latest = None  # Holds the newest timestamp seen
+
+    def add_packet(self, packet):
+        """Add a Scapy packet. Returns True if it was added"""
+        fields = ext.packet_fields(packet)
+        if fields is None:
+            return False
+        self.add_fields(fields, float(packet.time))
+        return True
+
+    def add_frame(self, frame, ts, linktype=DLT_EN10MB):
+        """Add a raw frame captured at ts. Returns True if it was added"""
+        fields = ext.frame_fields(frame, linktype)
+        if fields is None:
+            return False
+        self.add_fields(fields, ts)
+        return True
+
+    def add_fields(self, fields, ts):
+        """Add a packet in the packet_fields format captured at ts"""
+        mac_src, mac_dst, ip_src, ip_dst, w, sport, dport = fields
+        if self.latest is None or ts > self.latest:
+            self.latest = ts
+            self.expire(ts)
+        elif ts <= self.latest - self.window:
+            # Already outside of the window
+            return
+        if self.aggregate == ext.AGGREGATE_FLOW:
+            key = (sport, dport)
+        else:
+            key = 0
+            sport = dport = None
+        G = self.graph
+        d = G.get_edge_data(mac_src, mac_dst, key)
+        if d is None:
+            G.add_edge(
+                mac_src,
+                mac_dst,
+                key=key,
+                ip_src=ip_src,
+                ip_dst=ip_dst,
+                sport=sport,
+                dport=dport,
+                weight=w,
+                count=1,
+                last_ts=ts
+            )
+        else:
+            d["weight"] += w
+            d["count"] += 1
+            if ts > d["last_ts"]:
+                d["last_ts"] = ts
+        self._node_weight(mac_src, "out_weight", w)
+        self._node_weight(mac_dst, "in_weight", w)
+        if self.tracker is not None:
+            self.tracker.add(mac_src, mac_dst, w)
+        # Late packets are charged to the newest bucket so they never
+        # expire before packets that were counted ahead of them
+        number = max(floor(ts / self.resolution), self._newest_bucket())
+        if self.buckets and self.buckets[-1][0] == number:
+            counts = self.buckets[-1][1]
+        else:
+            counts = {}
+            self.buckets.append((number, counts))
+        edge = (mac_src, mac_dst, key)
+        if edge in counts:
+            c = counts[edge]
+            c[0] += w
+            c[1] += 1
+        else:
+            counts[edge] = [w, 1]
+
+    def expire(self, now):
+        """Drop the traffic of every bucket that ended before now - window"""
+        cutoff = now - self.window
+        buckets = self.buckets
+        while buckets and (buckets[0][0] + 1) * self.resolution <= cutoff:
+            number, counts = buckets.popleft()
+            for edge, (w, c) in counts.items():
+                self._remove(edge, w, c)
+
+    def _newest_bucket(self):
+        if self.buckets:
+            return self.buckets[-1][0]
+        return float("-inf")
+
+    def _node_weight(self, node, attr, w):
+        data = self.graph.nodes[node]
+        data[attr] = data.get(attr, 0) + w
+
+    def _remove(self, edge, w, c):
+        G = self.graph
+        u, v, key = edge
+        d = G.edges[u, v, key]
+        d["weight"] -= w
+        d["count"] -= c
+        if d["count"] <= 0:
+            G.remove_edge(u, v, key)
+        self._node_weight(u, "out_weight", -w)
+        self._node_weight(v, "in_weight", -w)
+        if self.tracker is not None:
+            self.tracker.add(u, v, -w, -c)
+        for node in (u, v):
+            if node in G and not G.succ[node] and not G.pred[node]:
+                G.remove_node(node)
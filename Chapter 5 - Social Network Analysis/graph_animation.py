@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+"""
+Animate how a reply graph grows over time.
+
+Animate_graph_evolution.ipynb draws every frame from scratch. This module
+adds only the users and replies that are new in each time step, and
+restarts the layout from where the last frame left it, moving just the
+nodes that changed. Nodes that didn't change stay still, so the animation
+doesn't jump about.
+
+Finished frames are saved as PNG files in a cache folder, together with a
+checkpoint of the layout. A render that is stopped part way carries on from
+the last checkpoint, and a render that is run again reuses every frame
+that is already on disk.
+
+e.g. python graph_animation.py -i fake_tweets.json -f 1000 -o evolution.gif
+"""
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+from optparse import OptionParser
+import numpy as np
+import pandas as pd
+from matplotlib import pyplot as plt
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
+from scipy.spatial import cKDTree
+
+CACHE_VERSION = 1
+
+
+class GraphAnimator:
+    """Lays out and draws the frames of a growing reply graph.
+
+    Posts are split into `frames` equal spans of time. Frame i shows every
+    user who posted and every reply made up to the end of span i.
+    """
+    def __init__(self, df, frames=100, time_col="created",
+                 source="in_reply_to_screen_name", target="user_screen_name",
+                 iterations=10, relax_every=0, seed=0, cache_dir=None,
+                 checkpoint=50, figsize=(8, 8), dpi=100, node_size=20):
+        """Parameters:
+            df: flattened posts, one row per post
+            frames: number of frames to split the posts into
+            time_col: column with the time of each post
+            source: column with the name of the user replied to
+            target: column with the name of the user who posted
+            iterations: layout steps run for each frame
+            relax_every: every this many frames, the nodes that changed
+                since the last time and their neighbours are moved again, to
+                settle the parts of the graph that grew (0 for never)
+            seed: seed for the positions given to new nodes
+            cache_dir: folder to keep finished frames in (no cache when None)
+            checkpoint: save the layout every this many frames
+            figsize, dpi: size of each frame
+            node_size: size of the node markers"""
+        posts = df.sort_values(time_col, kind="stable")
+        times = pd.to_datetime(posts[time_col]).to_numpy().astype(
+            "datetime64[ns]")
+        # Number the users in the order they first appear, replied to user
+        # first, so a reply's source is always placed before its target
+        pairs = np.empty(2 * len(posts), dtype=object)
+        pairs[0::2] = posts[source].to_numpy(dtype=object)
+        pairs[1::2] = posts[target].to_numpy(dtype=object)
+        codes, names = pd.factorize(pairs)
+        self.sources = codes[0::2]  # -1 for posts that aren't replies
+        self.targets = codes[1::2]
+        self.names = list(names)
+        edges = np.linspace(0, 1, frames + 1)[1:]
+        if len(times):
+            span = times[-1] - times[0]
+            ends = times[0] + (edges * span.astype(np.int64)).astype(
+                "timedelta64[ns]")
+            ends[-1] = times[-1]
+        else:
+            ends = np.array([], dtype="datetime64[ns]")
+        self.ends = ends
+        self.stops = np.searchsorted(times, ends, side="right")
+        self.frames = len(self.stops)
+        self.iterations = iterations
+        self.relax_every = relax_every
+        self.seed = seed
+        self.cache_dir = cache_dir
+        self.checkpoint = checkpoint
+        self.figsize = figsize
+        self.dpi = dpi
+        self.node_size = node_size
+        self.k = 1.0  # ideal edge length
+
+    def cache_key(self):
+        """A hash of the posts and settings the frames depend on"""
+        h = hashlib.sha1()
+        for arr in (self.sources, self.targets, self.stops,
+                    self.ends.astype(np.int64)):
+            h.update(np.ascontiguousarray(arr).tobytes())
+        h.update(json.dumps([
+            CACHE_VERSION, self.names, self.iterations, self.relax_every,
+            self.seed, list(self.figsize), self.dpi, self.node_size
+        ], default=str).encode())
+        return h.hexdigest()
+
+    def layouts(self, start=None):
+        """Yield (frame, title, positions, edges) for every frame.
+        positions is an array with a row per node seen so far, in the order
+        of self.names, and edges is an array of node index pairs. Both are
+        updated in place for the next frame, so copy them to keep them.
+        Parameters:
+            start: a (frame, positions, edge count) checkpoint to carry on
+                from instead of starting at the first frame"""
+        pos = np.zeros((len(self.names), 2))
+        edges = np.zeros((len(self.sources), 2), dtype=np.int64)
+        nbrs = [[] for _ in self.names]
+        seen = set()
+        n_nodes = n_edges = 0
+        done = 0
+        recent = set()
+        last = -1
+        if start is not None:
+            last, start_pos, start_edges = start
+            pos[:len(start_pos)] = start_pos
+
+        def add_edge(u, v):
+            """Add the reply u -> v, returns False if it was already drawn"""
+            nonlocal n_edges
+            pair = (min(u, v), max(u, v))
+            if u < 0 or u == v or pair in seen:
+                return False
+            seen.add(pair)
+            nbrs[u].append(v)
+            nbrs[v].append(u)
+            edges[n_edges] = (u, v)
+            n_edges += 1
+            return True
+
+        for frame in range(self.frames):
+            # Frames up to the checkpoint are only replayed to rebuild the
+            # graph, their positions are in the checkpoint already
+            replay = frame <= last
+            rng = np.random.default_rng((self.seed, frame))
+            moving = set()
+            stop = self.stops[frame]
+            for u, v in zip(self.sources[done:stop], self.targets[done:stop]):
+                for node, other in ((u, v), (v, u)):
+                    if node >= n_nodes:
+                        # Codes follow first appearance, so this is the next
+                        # new node. Start it next to the other user
+                        if not replay:
+                            pos[node] = self._place(pos, n_nodes, other, rng)
+                        n_nodes += 1
+                        moving.add(node)
+                if add_edge(u, v):
+                    moving.update((u, v))
+            done = stop
+            if self.relax_every:
+                recent.update(moving)
+                if (frame + 1) % self.relax_every == 0:
+                    moving = recent.union(*(nbrs[i] for i in recent))
+                    recent = set()
+            if replay:
+                if frame == last and (n_nodes != len(start_pos) or
+                                      n_edges != start_edges):
+                    raise ValueError("checkpoint doesn't match the posts")
+                continue
+            if moving:
+                self._relax(pos[:n_nodes], nbrs,
+                            np.fromiter(moving, dtype=np.int64))
+            title = str(self.ends[frame])[:10]
+            yield frame, title, pos[:n_nodes], edges[:n_edges]
+
+    def _place(self, pos, n, near, rng):
+        """Starting position of node n, next to node `near` if that is
+        placed already, otherwise somewhere inside the area already used"""
+        if near >= 0 and near < n:
+            return pos[near] + rng.normal(scale=self.k / 2, size=2)
+        if n == 0:
+            return np.zeros(2)
+        center = pos[:n].mean(axis=0)
+        radius = max(np.abs(pos[:n] - center).max(), self.k)
+        return center + rng.uniform(-radius, radius, size=2)
+
+    def _relax(self, pos, nbrs, moving):
+        """Fruchterman-Reingold steps that only move the nodes in `moving`.
+        Like the grid variant of the algorithm, nodes only push away the
+        nodes within 2k of them, found once with a k-d tree, so each step
+        costs about the number of moving nodes rather than that times the
+        number of nodes"""
+        k = self.k
+        m = len(moving)
+        # Pairs of (row in moving, node) for the edges pulling moving nodes
+        pull_rows = np.repeat(np.arange(m), [len(nbrs[i]) for i in moving])
+        pull_cols = np.fromiter((j for i in moving for j in nbrs[i]),
+                                dtype=np.int64, count=len(pull_rows))
+        near = cKDTree(pos[moving]).sparse_distance_matrix(
+            cKDTree(pos), 2 * k, output_type="ndarray")
+        push_rows = near["i"]
+        push_cols = near["j"]
+        rows = np.concatenate([push_rows, pull_rows])
+        cols = np.concatenate([push_cols, pull_cols])
+        pull = np.arange(len(rows)) >= len(push_rows)
+        t = k
+        dt = t / (self.iterations + 1)
+        for _ in range(self.iterations):
+            delta = pos[moving[rows]] - pos[cols]
+            dist2 = np.maximum((delta ** 2).sum(axis=1), 1e-4)
+            force = np.where(pull, -np.sqrt(dist2) / k, k * k / dist2)
+            disp = np.column_stack([
+                np.bincount(rows, delta[:, 0] * force, minlength=m),
+                np.bincount(rows, delta[:, 1] * force, minlength=m)
+            ])
+            length = np.maximum(np.sqrt((disp ** 2).sum(axis=1)), 0.01)
+            pos[moving] += disp * (np.minimum(length, t) / length)[:, None]
+            t -= dt
+
+    def render(self):
+        """Draw every frame into the cache folder, skipping frames that are
+        already there
+        Returns the list of PNG files"""
+        if self.cache_dir is None:
+            raise ValueError("render needs a cache_dir")
+        self._open_cache()
+        files = [self.frame_file(i) for i in range(self.frames)]
+        missing = [i for i, f in enumerate(files) if not os.path.exists(f)]
+        if not missing:
+            return files
+        start, limits = self._load_checkpoint(missing[0])
+        # A bare Figure, so rendering doesn't touch the pyplot backend of a
+        # notebook it is run from
+        fig = Figure(figsize=self.figsize)
+        ax, nodes, lines = self._artists(fig)
+        for frame, title, pos, edges in self.layouts(start):
+            limits = self._limits(pos, limits)
+            if not os.path.exists(files[frame]):
+                self._draw(ax, nodes, lines, title, pos, edges, limits)
+                fig.savefig(files[frame], dpi=self.dpi)
+            if (frame + 1) % self.checkpoint == 0 or frame == self.frames - 1:
+                self._save_checkpoint(frame, pos, len(edges), limits)
+            if frame == missing[-1]:
+                break
+        return files
+
+    def save(self, out_file, fps=15):
+        """Render the frames and join them into a GIF (with Pillow) or a
+        video (any other extension, with ffmpeg)"""
+        files = self.render()
+        if out_file.lower().endswith(".gif"):
+            from PIL import Image
+            # Open the frames one at a time rather than all at once
+            rest = (Image.open(f) for f in files[1:])
+            Image.open(files[0]).save(out_file, save_all=True,
+                                      append_images=rest,
+                                      duration=int(1000 / fps), loop=0)
+            return
+        if shutil.which("ffmpeg") is None:
+            raise RuntimeError("ffmpeg is needed to write %s" % out_file)
+        subprocess.run([
+            "ffmpeg", "-y", "-loglevel", "error", "-framerate", str(fps),
+            "-i", os.path.join(self.cache_dir, "frame_%05d.png"),
+            "-pix_fmt", "yuv420p", out_file
+        ], check=True)
+
+    def animation(self, interval=70):
+        """A matplotlib FuncAnimation of the frames, e.g. for
+        HTML(anim.to_html5_video()) in a notebook. Frames are laid out the
+        first time they are drawn and kept in memory"""
+        from matplotlib import animation
+        fig = plt.figure(figsize=self.figsize)
+        ax, nodes, lines = self._artists(fig)
+        frames = self.layouts()
+        done = []
+        state = {"limits": None, "edges": None}
+
+        def draw(i):
+            while len(done) <= i:
+                frame, title, pos, edges = next(frames)
+                state["limits"] = self._limits(pos, state["limits"])
+                # Edges are only ever appended, so a count is enough to get
+                # back the edges of an earlier frame
+                state["edges"] = edges.base
+                done.append((title, pos.copy(), len(edges), state["limits"]))
+            title, pos, n_edges, limits = done[i]
+            self._draw(ax, nodes, lines, title, pos, state["edges"][:n_edges],
+                       limits)
+            return nodes, lines
+
+        return animation.FuncAnimation(fig, draw, frames=self.frames,
+                                       interval=interval, repeat=False)
+
+    def frame_file(self, frame):
+        return os.path.join(self.cache_dir, "frame_%05d.png" % frame)
+
+    def _artists(self, fig):
+        ax = fig.add_subplot()
+        ax.set_axis_off()
+        # Solid lines, dotted ones take over twice as long to draw
+        lines = LineCollection([], colors="k", linewidths=0.5, alpha=0.25)
+        ax.add_collection(lines)
+        nodes = ax.scatter([], [], s=self.node_size)
+        return ax, nodes, lines
+
+    def _limits(self, pos, limits):
+        """Grow the axis limits to fit pos. They never shrink, so nodes that
+        don't move stay in the same place on screen"""
+        if not len(pos):
+            return limits
+        lo = pos.min(axis=0) - self.k
+        hi = pos.max(axis=0) + self.k
+        if limits is not None:
+            lo = np.minimum(lo, limits[0])
+            hi = np.maximum(hi, limits[1])
+        return lo, hi
+
+    def _draw(self, ax, nodes, lines, title, pos, edges, limits):
+        """Update the artists for one frame"""
+        nodes.set_offsets(pos)
+        lines.set_segments(pos[edges])
+        ax.set_title(title)
+        if limits is not None:
+            ax.set_xlim(limits[0][0], limits[1][0])
+            ax.set_ylim(limits[0][1], limits[1][1])
+
+    def _open_cache(self):
+        """Empty the cache folder if it holds frames of other posts or
+        settings"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        key_file = os.path.join(self.cache_dir, "cache.json")
+        key = self.cache_key()
+        if os.path.exists(key_file):
+            with open(key_file) as f:
+                if json.load(f).get("key") == key:
+                    return
+        for name in os.listdir(self.cache_dir):
+            if name.startswith("frame_") or name == "layout.npz":
+                os.remove(os.path.join(self.cache_dir, name))
+        with open(key_file, "w") as f:
+            json.dump({"key": key, "frames": self.frames}, f)
+
+    def _load_checkpoint(self, first_missing):
+        """The newest saved layout from before first_missing and the axis
+        limits at that frame, or (None, None)"""
+        try:
+            with np.load(os.path.join(self.cache_dir, "layout.npz")) as data:
+                frame = int(data["frame"])
+                if frame < first_missing:
+                    start = (frame, data["pos"], int(data["edges"]))
+                    limits = tuple(data["limits"]) if len(data["limits"]) else None
+                    return start, limits
+        except (OSError, KeyError, ValueError):
+            pass
+        return None, None
+
+    def _save_checkpoint(self, frame, pos, n_edges, limits):
+        ckpt = os.path.join(self.cache_dir, "layout.npz")
+        tmp_file = ckpt + ".tmp"
+        with open(tmp_file, "wb") as f:
+            np.savez(f, frame=frame, pos=pos, edges=n_edges,
+                     limits=np.empty((0, 2)) if limits is None else limits)
+        os.replace(tmp_file, ckpt)
+
+
+if __name__ == '__main__':
+    from social_data import load_posts
+
+    parser = OptionParser()
+    parser.add_option("-i", "--input", dest="json_file",
+        default="fake_tweets.json", help="JSON lines file of posts")
+    parser.add_option("-o", "--out", dest="out_file", default="evolution.gif",
+        help="GIF or video file to write (default evolution.gif)")
+    parser.add_option("-f", "--frames", dest="frames", default=100,
+        type="int", help="Number of frames (default 100)")
+    parser.add_option("-c", "--cache", dest="cache_dir", default=None,
+        help="Folder to keep finished frames in (default OUT.frames)")
+    parser.add_option("-t", "--time-col", dest="time_col",
+        default="created_at", help="Column with the post times "
+        "(default created_at)")
+    parser.add_option("--fps", dest="fps", default=15, type="int",
+        help="Frames per second (default 15)")
+
+    (opts, args) = parser.parse_args()
+    posts = load_posts(opts.json_file)
+    animator = GraphAnimator(
+        posts,
+        frames=opts.frames,
+        time_col=opts.time_col,
+        cache_dir=opts.cache_dir or opts.out_file + ".frames"
+    )
+    animator.save(opts.out_file, fps=opts.fps)
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+The ratio of Potential to Kinetic Information over a sliding time window.
+
+Mastodon_network.ipynb works the ratio out once for the whole DataFrame:
+originals that nobody replied to hold potential information, originals that
+got replies hold kinetic information. InformationRatio keeps the same counts
+for the posts of the last `window` seconds only, updated as each post
+arrives, so the ratio can be followed while a timeline is being harvested.
+
+Posts are counted into time buckets `resolution` seconds wide, the same way
+as Chapter 4's window_graph. A bucket keeps the IDs of its originals and
+of the posts its replies answered, and takes them off the counts again when
+it falls out of the window, so each post costs O(1) to add and expire.
+
+e.g. python info_ratio.py -i toots.jsonl -w 3600 -r 300
+"""
+from collections import deque
+from math import floor, inf
+from optparse import OptionParser
+import pandas as pd
+
+
+class InformationRatio:
+    """Sliding window ratio of Potential to Kinetic Information."""
+    def __init__(self, window=3600, resolution=60):
+        """Parameters:
+            window: number of seconds of posts to keep, None for all of them
+            resolution: width in seconds of the expiry buckets"""
+        self.window = window
+        self.resolution = resolution
+        self.originals = {}  # Holds post ID: number of originals with it
+        self.replied = {}  # Holds post ID: number of replies to it
+        self.n_originals = 0
+        self.n_replies = 0
+        self.kinetic = 0  # Holds the number of originals with a reply
+        # Holds (bucket number, [original IDs], [replied to IDs])
+        self.buckets = deque()
+        self.latest = None  # Holds the newest timestamp seen
+
+    def add(self, post_id, reply_to_id, ts):
+        """Add a post made at unix time ts. reply_to_id is the ID of the
+        post it replies to, None or NaN for an original"""
+        if self.latest is None or ts > self.latest:
+            self.latest = ts
+            self.expire(ts)
+        elif self.window is not None and ts <= self.latest - self.window:
+            # Already outside of the window
+            return
+        # Late posts are charged to the newest bucket so they never expire
+        # before posts that were counted ahead of them
+        number = floor(ts / self.resolution)
+        if self.buckets and self.buckets[-1][0] >= number:
+            bucket = self.buckets[-1]
+        else:
+            bucket = (number, [], [])
+            self.buckets.append(bucket)
+        if pd.isna(reply_to_id):
+            self._add_original(post_id, 1)
+            bucket[1].append(post_id)
+        else:
+            self._add_reply(reply_to_id, 1)
+            bucket[2].append(reply_to_id)
+
+    def expire(self, now):
+        """Drop the posts of every bucket that ended before now - window"""
+        if self.window is None:
+            return
+        cutoff = now - self.window
+        buckets = self.buckets
+        while buckets and (buckets[0][0] + 1) * self.resolution <= cutoff:
+            number, originals, replied = buckets.popleft()
+            for post_id in originals:
+                self._add_original(post_id, -1)
+            for post_id in replied:
+                self._add_reply(post_id, -1)
+
+    def counts(self):
+        """Return (potential, kinetic): the number of originals in the
+        window without and with a reply in the window"""
+        return self.n_originals - self.kinetic, self.kinetic
+
+    def ratio(self):
+        """The ratio of Potential to Kinetic Information in the window.
+        Like the notebook it is -1 when there are no replies, and it is
+        inf when there are replies but none to an original in the window"""
+        if self.n_replies == 0:
+            return -1
+        potential, kinetic = self.counts()
+        if kinetic == 0:
+            return inf
+        return potential / kinetic
+
+    def _add_original(self, post_id, n):
+        c = self.originals.get(post_id, 0) + n
+        if c:
+            self.originals[post_id] = c
+        else:
+            del self.originals[post_id]
+        self.n_originals += n
+        if post_id in self.replied:
+            self.kinetic += n
+
+    def _add_reply(self, post_id, n):
+        before = self.replied.get(post_id, 0)
+        c = before + n
+        if c:
+            self.replied[post_id] = c
+        else:
+            del self.replied[post_id]
+        self.n_replies += n
+        if (before == 0 or c == 0) and post_id in self.originals:
+            # The post just got its first reply, or lost its last one
+            self.kinetic += n * self.originals[post_id]
+
+
+def ratio_stream(posts, window=3600, resolution=60):
+    """Feed (post ID, reply to ID, unix time) tuples through an
+    InformationRatio and yield (time, ratio) each time a bucket closes, with
+    time the end of that bucket, and once more for the last post"""
+    info = InformationRatio(window, resolution)
+    current = None
+    for post_id, reply_to_id, ts in posts:
+        number = floor(ts / resolution)
+        if current is not None and number > current:
+            end = (current + 1) * resolution
+            info.expire(end)
+            yield end, info.ratio()
+        if current is None or number > current:
+            current = number
+        info.add(post_id, reply_to_id, ts)
+    if current is not None:
+        yield info.latest, info.ratio()
+
+
+def ratio_series(df, window=3600, resolution=60, id_col="id",
+                 reply_col="in_reply_to_id", time_col="created_at"):
+    """The ratio over time of a DataFrame of posts as a pandas Series,
+    indexed by the end time of each bucket
+    Parameters:
+        df: flattened posts, one row per post
+        window: number of seconds of posts to keep, None for all of them
+        resolution: width in seconds of each step of the series
+        id_col, reply_col, time_col: columns with the post ID, the ID of
+            the post replied to and the time of the post"""
+    times = pd.to_datetime(df[time_col], utc=True)
+    posts = df.assign(_ts=(times - pd.Timestamp(0, tz="UTC")).dt.total_seconds())
+    posts = posts.sort_values("_ts", kind="stable")
+    stream = ratio_stream(
+        zip(posts[id_col], posts[reply_col], posts["_ts"]), window, resolution)
+    points = list(stream)
+    index = pd.to_datetime([t for t, r in points], unit="s", utc=True)
+    return pd.Series([r for t, r in points], index=index, name="ratio")
+
+
+if __name__ == '__main__':
+    from social_data import load_posts
+
+    parser = OptionParser()
+    parser.add_option("-i", "--input", dest="json_file",
+        default="fake_toots.json", help="JSON lines file of posts, e.g. "
+        "from mastodon_harvest.py")
+    parser.add_option("-w", "--window", dest="window", default=3600,
+        type="float", help="Seconds of posts the ratio covers (default 3600)")
+    parser.add_option("-r", "--resolution", dest="resolution", default=300,
+        type="float", help="Seconds between points of the series "
+        "(default 300)")
+
+    (opts, args) = parser.parse_args()
+    # Harvested posts aren't in time order, so load and sort them first
+    posts = load_posts(opts.json_file)
+    series = ratio_series(posts, opts.window, opts.resolution)
+    for ts, ratio in series.items():
+        print("%s\t%.4f" % (ts, ratio))
@@ -0,0 +1,450 @@
+# -*- coding: utf-8 -*-
+"""
+Harvest a Mastodon timeline page by page.
+
+mastodon_poc.py only fetches the newest page of the public timeline. The
+harvester here keeps paging back through the timeline and streams every
+post to a CSV or JSON lines file as it arrives. It remembers the newest
+(since_id) and oldest (max_id) post it has seen in a small state file, so
+running it again only fetches the posts written since the last run.
+The state also lists the gaps a run left behind, when -n stopped it or it
+was interrupted, and the next run fills them in first. The state is saved
+after every page, so posts are only written twice if the harvester is
+killed between writing a page and saving the state.
+
+Mastodon post IDs are snowflakes: the top 48 bits are the time the post was
+made in milliseconds. That lets the range of IDs between two points in time
+be cut into slices that are paged through at the same time, with no more
+than `workers` requests in flight. Servers that don't use snowflake IDs are
+paged through one page at a time.
+
+e.g. python mastodon_harvest.py -u https://defcon.social -H 48 -o toots.jsonl
+"""
+import csv
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from optparse import OptionParser
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+ACCESS_TOKEN = None  # Set to "YOUR-API-KEY" for timelines that need one
+BASE_URL = "https://defcon.social"
+PAGE_LIMIT = 40  # the most posts Mastodon returns per timeline page
+SLICES_PER_WORKER = 4  # smaller slices keep every worker busy until the end
+RETRIES = 5
+
+
+def snowflake_from_time(t):
+    """The lowest snowflake ID a post made at unix time t can have"""
+    return int(t * 1000) << 16
+
+
+def is_snowflake(post_id):
+    """Whether an ID looks like a snowflake (a millisecond time after 2001)"""
+    return int(post_id) >> 16 > 10 ** 12
+
+
+def _str_id(post_id):
+    """IDs are kept as strings, like the API returns them"""
+    return None if post_id is None else str(post_id)
+
+
+class TimelineHarvester:
+    """Pages through a Mastodon timeline with a bounded number of requests
+    in flight.
+
+    Posts are handed to a sink (see JsonLinesSink and CsvSink) as soon as
+    each page arrives. Pages can arrive in any order, so the output is not
+    sorted by ID.
+    """
+    def __init__(self, base_url=BASE_URL, access_token=ACCESS_TOKEN,
+                 timeline="public", workers=4, page_limit=PAGE_LIMIT,
+                 local=False, timeout=30):
+        """Parameters:
+            base_url: the server to harvest, e.g. https://defcon.social
+            access_token: API token, only needed for private timelines
+            timeline: "public" or a hashtag as "tag/<name>"
+            workers: the most requests in flight at once
+            page_limit: posts asked for per page (Mastodon's max is 40)
+            local: only posts made on this server
+            timeout: seconds to wait for each response"""
+        self.base_url = base_url.rstrip("/")
+        self.access_token = access_token
+        self.timeline = timeline
+        self.workers = workers
+        self.page_limit = page_limit
+        self.local = local
+        self.timeout = timeout
+        self.requests = 0  # Holds the number of pages fetched
+        self.posts = 0  # Holds the number of posts written to sinks
+        self._lock = threading.Lock()
+
+    def fetch_page(self, max_id=None, since_id=None):
+        """Fetch one page of the timeline, newest first. Both IDs are
+        exclusive. Retries when rate limited or on server errors"""
+        params = {"limit": self.page_limit}
+        if max_id is not None:
+            params["max_id"] = max_id
+        if since_id is not None:
+            params["since_id"] = since_id
+        if self.local:
+            params["local"] = "true"
+        url = "%s/api/v1/timelines/%s?%s" % (
+            self.base_url, self.timeline, urlencode(params))
+        headers = {"Accept": "application/json"}
+        if self.access_token:
+            headers["Authorization"] = "Bearer %s" % self.access_token
+        for attempt in range(RETRIES):
+            try:
+                with urlopen(Request(url, headers=headers),
+                             timeout=self.timeout) as resp:
+                    page = json.load(resp)
+                with self._lock:
+                    self.requests += 1
+                return page
+            except HTTPError as e:
+                if e.code != 429 and e.code < 500 or attempt == RETRIES - 1:
+                    raise
+                time.sleep(_retry_wait(e, attempt))
+            except URLError:
+                if attempt == RETRIES - 1:
+                    raise
+                time.sleep(2 ** attempt)
+
+    def harvest(self, sink, since_id=None, max_id=None, max_posts=None,
+                on_page=None):
+        """Fetch every post between since_id and max_id (both exclusive,
+        None for no limit) and write them to sink.
+        Parameters:
+            sink: an object with a write(posts) method
+            since_id: only fetch posts newer than this ID
+            max_id: only fetch posts older than this ID
+            max_posts: stop after about this many posts. The timeline is
+                then paged through newest first, one page at a time, so the
+                posts not fetched are a single range older than the rest
+            on_page: called as on_page(newest, oldest, gaps) after each page
+                is written, e.g. to save the progress
+        Returns a tuple of (newest ID, oldest ID, gaps). gaps lists the
+        [since_id, max_id] ranges (both exclusive) that weren't fetched
+        because max_posts stopped the harvest, and is empty when every post
+        was fetched. The IDs are None when no posts were found"""
+        run = _Run(sink, max_posts, since_id, max_id, on_page)
+        try:
+            self._harvest(run, since_id, max_id)
+        finally:
+            self.posts += run.count
+        return run.newest, run.oldest, run.gaps()
+
+    def _harvest(self, run, since_id, max_id):
+        """Page through the range of run, cut into slices when it can be"""
+        first = self.fetch_page(max_id=max_id, since_id=since_id)
+        done = len(first) < self.page_limit
+        run.add(0, first, done)
+        if done or run.full():
+            return
+        upper = int(run.oldest)
+        if (since_id is None or run.max_posts is not None
+                or not is_snowflake(upper)):
+            self._page_back(run, 0, upper, since_id)
+        else:
+            lower = int(since_id)
+            slices = self.workers * SLICES_PER_WORKER
+            bounds = sorted({lower + (upper - lower) * i // slices
+                             for i in range(slices + 1)})
+            # Each slice includes its lower bound, except the first which
+            # stops before since_id
+            ranges = [(hi, lo if lo == lower else lo - 1)
+                      for lo, hi in zip(bounds[:-1], bounds[1:])]
+            run.split(0, ranges)
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                jobs = [
+                    pool.submit(self._page_back, run, key, hi, lo)
+                    for key, (hi, lo) in enumerate(ranges, 1)
+                ]
+                for job in jobs:
+                    job.result()
+
+    def _page_back(self, run, key, max_id, since_id):
+        """Page back through range key of the run, from max_id until
+        since_id or the start of the timeline"""
+        while not run.full():
+            page = self.fetch_page(max_id=max_id, since_id=since_id)
+            run.add(key, page, not page)
+            if not page:
+                return
+            max_id = min(int(p["id"]) for p in page)
+
+
+class _Run:
+    """Shared state of one harvest, updated by every worker"""
+    def __init__(self, sink, max_posts, since_id, max_id, on_page=None):
+        self.sink = sink
+        self.max_posts = max_posts
+        self.on_page = on_page
+        self.count = 0
+        self.newest = None
+        self.oldest = None
+        # Holds range number: [since_id, max_id] of what is left to fetch
+        # of each range being paged through
+        self.pending = {0: [_str_id(since_id), _str_id(max_id)]}
+        self._lock = threading.Lock()
+
+    def full(self):
+        return self.max_posts is not None and self.count >= self.max_posts
+
+    def gaps(self):
+        """The ranges that are still to be fetched, newest first"""
+        with self._lock:
+            return self._gaps()
+
+    def split(self, key, ranges):
+        """Replace range key with the (max_id, since_id) ranges numbered
+        key + 1, key + 2 and so on"""
+        with self._lock:
+            del self.pending[key]
+            for i, (max_id, since_id) in enumerate(ranges, key + 1):
+                self.pending[i] = [_str_id(since_id), _str_id(max_id)]
+
+    def add(self, key, page, done=False):
+        """Write a page of range key, done when the range has no posts
+        left"""
+        with self._lock:
+            if page:
+                ids = [int(p["id"]) for p in page]
+                self.sink.write(page)
+                self.count += len(page)
+                if self.newest is None or max(ids) > int(self.newest):
+                    self.newest = str(max(ids))
+                if self.oldest is None or min(ids) < int(self.oldest):
+                    self.oldest = str(min(ids))
+                self.pending[key][1] = str(min(ids))
+            if done:
+                del self.pending[key]
+            if self.on_page is not None:
+                self.on_page(self.newest, self.oldest, self._gaps())
+
+    def _gaps(self):
+        return sorted(
+            (list(r) for r in self.pending.values()),
+            key=lambda r: float("-inf") if r[1] is None else -int(r[1]))
+
+
+class JsonLinesSink:
+    """Appends posts to a file as one JSON object per line, the format the
+    Chapter 5 notebooks load"""
+    def __init__(self, out_file):
+        self.f = open(out_file, "a", encoding="utf-8")
+
+    def write(self, posts):
+        for post in posts:
+            self.f.write(json.dumps(post) + "\n")
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class CsvSink:
+    """Appends posts to a CSV file with a column per top level field, like
+    the one mastodon_poc.py writes. Nested objects such as the account are
+    stored as JSON. The columns are taken from the file's header, or from
+    the first post for a new file"""
+    def __init__(self, out_file):
+        self.out_file = out_file
+        self.columns = None
+        if os.path.exists(out_file) and os.path.getsize(out_file) > 0:
+            with open(out_file, newline="", encoding="utf-8") as f:
+                self.columns = next(csv.reader(f))
+        self.f = open(out_file, "a", newline="", encoding="utf-8")
+        self.writer = None
+        if self.columns is not None:
+            self.writer = csv.DictWriter(
+                self.f, self.columns, extrasaction="ignore")
+
+    def write(self, posts):
+        for post in posts:
+            if self.writer is None:
+                self.columns = list(post.keys())
+                self.writer = csv.DictWriter(
+                    self.f, self.columns, extrasaction="ignore")
+                self.writer.writeheader()
+            self.writer.writerow({
+                k: json.dumps(v) if isinstance(v, (dict, list)) else v
+                for k, v in post.items()
+            })
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+def open_sink(out_file):
+    """A CsvSink for .csv files, a JsonLinesSink for anything else"""
+    if out_file.lower().endswith(".csv"):
+        return CsvSink(out_file)
+    return JsonLinesSink(out_file)
+
+
+def load_state(state_file):
+    """Load the state saved by a previous run: the newest (since_id) and
+    oldest (max_id) post harvested, and the gaps between them that are
+    still to be fetched"""
+    state = {"since_id": None, "max_id": None, "gaps": []}
+    if os.path.exists(state_file):
+        with open(state_file) as f:
+            state.update(json.load(f))
+    return state
+
+
+def harvest_ranges(state, older=False, since_time=None):
+    """The [since_id, max_id] ranges a run should harvest, newest first.
+    A run fetches the posts newer than since_id, or made after since_time
+    on the first run, then fills in the gaps. With older it pages back
+    from max_id instead"""
+    if older:
+        return [[None, state["max_id"]]]
+    since_id = state["since_id"]
+    if since_id is None and since_time is not None:
+        since_id = str(snowflake_from_time(since_time))
+    return [[since_id, None]] + [list(g) for g in state["gaps"]]
+
+
+def update_state(state, target, newest, oldest, gaps):
+    """Return a copy of state with the progress of harvesting one range
+    Parameters:
+        state: the state before the range was harvested
+        target: the [since_id, max_id] range harvested
+        newest, oldest, gaps: what harvest returned, or passed to on_page"""
+    new = dict(state)
+    new_gaps = [g for g in state["gaps"] if g != target]
+    for since_id, max_id in gaps:
+        # A range with no max_id hasn't been started yet, and everything
+        # before the oldest post is left to --older
+        if since_id is not None and max_id is not None:
+            new_gaps.append([since_id, max_id])
+    if newest is not None:
+        if new["since_id"] is None or int(newest) > int(new["since_id"]):
+            new["since_id"] = newest
+        if new["max_id"] is None or int(oldest) < int(new["max_id"]):
+            new["max_id"] = oldest
+    for since_id, max_id in new_gaps:
+        # --older must start below every gap, or it would fetch their posts
+        # a second time
+        if int(since_id) + 1 < int(new["max_id"]):
+            new["max_id"] = str(int(since_id) + 1)
+    new["gaps"] = sorted(new_gaps, key=lambda g: -int(g[1]))
+    return new
+
+
+def run_harvest(harvester, sink, state, state_file, ranges, max_posts=None):
+    """Harvest each range in turn, saving the state after every page so an
+    interrupted run carries on from where it stopped. Returns the new
+    state.
+    Parameters:
+        harvester: the TimelineHarvester to fetch with
+        sink: an object with a write(posts) method
+        state: the state from load_state
+        state_file: the path to save the state to
+        ranges: the ranges to harvest, from harvest_ranges
+        max_posts: stop after about this many posts"""
+    start = harvester.posts
+    for target in ranges:
+        remaining = None
+        if max_posts is not None:
+            remaining = max_posts - (harvester.posts - start)
+            if remaining <= 0:
+                break
+        base = state
+
+        def save_progress(newest, oldest, gaps):
+            save_state(update_state(base, target, newest, oldest, gaps),
+                       state_file)
+
+        newest, oldest, gaps = harvester.harvest(
+            sink, target[0], target[1], remaining, save_progress)
+        state = update_state(base, target, newest, oldest, gaps)
+    save_state(state, state_file)
+    return state
+
+
+def save_state(state, state_file):
+    """Save the state, replacing the old file only once the new one is
+    written"""
+    tmp_file = state_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_file, state_file)
+
+
+def _retry_wait(e, attempt):
+    """Seconds to wait before retrying a failed request"""
+    if e.code == 429:
+        retry_after = e.headers.get("Retry-After")
+        if retry_after is not None and retry_after.isdigit():
+            return int(retry_after)
+        reset = e.headers.get("X-RateLimit-Reset")
+        if reset is not None:
+            try:
+                at = datetime.fromisoformat(reset.replace("Z", "+00:00"))
+                return max(1, (at - datetime.now(timezone.utc)).total_seconds())
+            except ValueError:
+                pass
+    return 2 ** attempt
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("-u", "--base-url", dest="base_url", default=BASE_URL,
+        help="Mastodon server to harvest (default %s)" % BASE_URL)
+    parser.add_option("-t", "--token", dest="token", default=ACCESS_TOKEN,
+        help="API access token, if the timeline needs one")
+    parser.add_option("-T", "--timeline", dest="timeline", default="public",
+        help="Timeline to harvest, 'public' or 'tag/<hashtag>' "
+        "(default public)")
+    parser.add_option("-o", "--out", dest="out_file",
+        default="mastodon_timeline.csv", help="CSV or .jsonl file to append "
+        "the posts to (default mastodon_timeline.csv)")
+    parser.add_option("-s", "--state", dest="state_file", default=None,
+        help="File keeping the since_id/max_id between runs "
+        "(default OUT.state.json)")
+    parser.add_option("-w", "--workers", dest="workers", default=4,
+        type="int", help="Most requests in flight at once (default 4)")
+    parser.add_option("-n", "--max-posts", dest="max_posts", default=None,
+        type="int", help="Stop after about this many posts")
+    parser.add_option("-H", "--hours", dest="hours", default=24,
+        type="float", help="On the first run, how many hours back to "
+        "harvest (default 24)")
+    parser.add_option("--older", dest="older", action="store_true",
+        default=False, help="Page further back from the oldest post "
+        "harvested so far instead of fetching new posts")
+    parser.add_option("--local", dest="local", action="store_true",
+        default=False, help="Only posts made on this server")
+
+    (opts, args) = parser.parse_args()
+    state_file = opts.state_file or opts.out_file + ".state.json"
+    state = load_state(state_file)
+    harvester = TimelineHarvester(
+        opts.base_url,
+        opts.token,
+        timeline=opts.timeline,
+        workers=opts.workers,
+        local=opts.local
+    )
+    ranges = harvest_ranges(state, opts.older,
+                            time.time() - opts.hours * 3600)
+    sink = open_sink(opts.out_file)
+    start = time.time()
+    try:
+        state = run_harvest(harvester, sink, state, state_file, ranges,
+                            opts.max_posts)
+    finally:
+        sink.close()
+    print("Fetched %d posts in %d pages in %.1f seconds, newest %s, "
+          "oldest %s, %d gaps left" % (
+              harvester.posts, harvester.requests, time.time() - start,
+              state["since_id"], state["max_id"], len(state["gaps"])))
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for preparing the social media posts used in the Chapter 5
+notebooks.
+"""
+import json
+from itertools import islice
+import networkx as nx
+import pandas as pd
+
+CHUNK_SIZE = 50000  # posts parsed into a DataFrame at a time
+
+
+def load_posts(json_file, nested=None, chunk_size=CHUNK_SIZE):
+    """Load a file of JSON posts, one per line, into a flat DataFrame.
+    The nested user object of every post becomes columns prefixed with
+    user_ (e.g. user_screen_name), the same columns user_to_series made.
+    The file is read chunk_size lines at a time and each chunk is flattened
+    in one go, so the raw text and JSON objects of the whole file are never
+    held in memory at once.
+    Parameters:
+        json_file: the path to the posts, e.g. fake_toots.json
+        nested: the field holding the user, "user" for tweets and posts or
+            "account" for toots (found from the first post when None)
+        chunk_size: number of posts flattened at a time"""
+    chunks = []
+    with open(json_file, encoding="utf-8") as f:
+        while True:
+            lines = list(islice(f, chunk_size))
+            if not lines:
+                break
+            rows = [json.loads(line) for line in lines if line.strip()]
+            if not rows:
+                continue
+            if nested is None:
+                nested = "account" if "account" in rows[0] else "user"
+            users = [row.pop(nested, None) or {} for row in rows]
+            chunk = pd.DataFrame(rows)
+            user_df = pd.DataFrame(users, index=chunk.index)
+            chunks.append(pd.concat([chunk, user_df.add_prefix("user_")],
+                                    axis=1))
+    if not chunks:
+        return pd.DataFrame()
+    df = pd.concat(chunks, ignore_index=True)
+    # A chunk where a column is always empty gets an object column, which
+    # stops the whole column from getting the type of its values
+    return df.infer_objects()
+
+
+def add_reply_username(df, id_col="in_reply_to_account_id",
+                       user_col="user_id", name_col="user_screen_name",
+                       out_col="in_reply_to_screen_name"):
+    """Return a copy of df with the screen name of the user each post
+    replies to.
+    Each user ID is looked up once in a table built from the first post by
+    every user, instead of searching the whole DataFrame for every reply.
+    Posts that aren't replies, or reply to a user with no posts in df, get
+    NaN.
+    Parameters:
+        df: flattened posts, one row per post
+        id_col: column with the ID of the user replied to
+        user_col: column with the ID of the user who posted
+        name_col: column with the screen name of the user who posted
+        out_col: column to write the screen names to"""
+    users = df.drop_duplicates(user_col)
+    users = users[users[user_col].notna()]
+    names = pd.Series(users[name_col].values, index=users[user_col].values)
+    copy = df.copy()
+    copy[out_col] = df[id_col].map(names)
+    return copy
+
+
+def reply_graph(df, source="in_reply_to_screen_name",
+                target="user_screen_name", text="text", agg="sum", G=None):
+    """Build the directed reply graph of a set of posts, with an edge from
+    the user replied to (source) to the user who replied (target).
+    Each edge's capacity is the length of the text of the replies along it,
+    combined with agg: "sum" adds them up, "last" keeps the latest like
+    calling add_edge once per reply did. The pairs are grouped in one pass
+    and the edges added in the order they first appear in df, so the graph
+    is the same as one built row by row. Rows with no source are skipped.
+    Parameters:
+        df: flattened posts, one row per post
+        source: column with the screen name of the user replied to
+        target: column with the screen name of the user who posted
+        text: column with the text of the post
+        agg: how to combine the capacity of repeated replies
+        G: graph to add the edges to (a new DiGraph when None)"""
+    if G is None:
+        G = nx.DiGraph()
+    caps = df[text].str.len().groupby(
+        [df[source], df[target]], sort=False).agg(agg)
+    G.add_edges_from(
+        (u, v, {"capacity": w})
+        for (u, v), w in zip(caps.index, caps.tolist())
+    )
+    return G
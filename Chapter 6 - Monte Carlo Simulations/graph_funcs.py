@@ -1,7 +1,14 @@
 # -*- coding: utf-8 -*-
+import json
+from bisect import bisect_left
+from itertools import accumulate, islice
 import networkx as nx
+import numpy as np
+import pandas as pd
 from random import random
 
+CHUNK_SIZE = 50000  # posts parsed into a DataFrame at a time
+
 
 def _ra(G, u, v, resource=1):
     
@@ -26,21 +33,190 @@ def weighted_choice(scores):
     """Input a dictionary of key: weight
     Output a key selected with probability
     equal to it's relative weight.
-    Weights do not need to sum to 1"""
-    totals = []
-    running_total = 0
+    Weights do not need to sum to 1, but can't be negative.
+    The running totals are searched with bisect, which finds the same key
+    as scanning them in order"""
+    keys = list(scores.keys())
+    totals = list(accumulate(scores.values()))
+    running_total = totals[-1] if totals else 0
+    rnd = random() * running_total
+    i = bisect_left(totals, rnd)
+    if i < len(keys):
+        return keys[i]
+
+
+class WeightedSampler:
+    """Draws keys with probability equal to their relative weight, like
+    weighted_choice, from a table that is built once and can be changed.
+
+    The weights are kept in a Fenwick tree (binary indexed tree) of
+    running totals, so a draw and a weight change both cost O(log n)
+    instead of the O(n) weighted_choice spends building the totals.
+    Draws pick the same key weighted_choice would for the same random
+    number, give or take float rounding in the totals.
+    """
+    def __init__(self, scores=None):
+        """Parameters:
+            scores: a dictionary of key: weight to start from"""
+        self.keys = []
+        self.index = {}  # Holds key: position in keys
+        self.weights = []
+        self.tree = [0]  # 1 based Fenwick tree, tree[0] is unused
+        if scores:
+            self.keys = list(scores.keys())
+            self.index = {k: i for i, k in enumerate(self.keys)}
+            self.weights = list(scores.values())
+            # Build the tree in O(n) by pushing each node's sum to its parent
+            tree = [0] + self.weights
+            n = len(tree)
+            for i in range(1, n):
+                parent = i + (i & -i)
+                if parent < n:
+                    tree[parent] += tree[i]
+            self.tree = tree
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def weight(self, key):
+        return self.weights[self.index[key]]
+
+    def total(self):
+        """The sum of all the weights"""
+        return self._prefix(len(self.keys))
+
+    def update(self, key, weight):
+        """Set the weight of a key, adding the key if it is new. A key with
+        weight 0 is never drawn (unless every weight is 0)"""
+        i = self.index.get(key)
+        if i is None:
+            self._append(key, weight)
+            return
+        delta = weight - self.weights[i]
+        self.weights[i] = weight
+        tree = self.tree
+        i += 1
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+
+    def choice(self):
+        """Draw a key, None if there are none"""
+        if not self.keys:
+            return None
+        tree = self.tree
+        n = len(self.keys)
+        rnd = random() * self.total()
+        # Walk down the tree to the first key whose running total is at
+        # least rnd, the one bisect finds in weighted_choice
+        pos = 0
+        step = 1 << n.bit_length()
+        while step:
+            nxt = pos + step
+            if nxt <= n and tree[nxt] < rnd:
+                pos = nxt
+                rnd -= tree[nxt]
+            step >>= 1
+        return self.keys[min(pos, n - 1)]
+
+    def _prefix(self, i):
+        """Sum of the first i weights"""
+        tree = self.tree
+        total = 0
+        while i > 0:
+            total += tree[i]
+            i -= i & -i
+        return total
+
+    def _append(self, key, weight):
+        i = len(self.keys) + 1  # tree position of the new key
+        self.index[key] = len(self.keys)
+        self.keys.append(key)
+        self.weights.append(weight)
+        # tree[i] covers the weights from i - lowbit(i) + 1 up to i
+        self.tree.append(
+            weight + self._prefix(i - 1) - self._prefix(i - (i & -i)))
+
+
+class DegreeArrays:
+    """Keeps the in and out degree of every node of a DiGraph in NumPy
+    arrays, in the graph's node order, so preferential attachment scores
+    for every node are one array operation.
+
+    Edges must be added and removed through add_edge and remove_edge for
+    the arrays to stay in step with the graph.
+    """
+    def __init__(self, G):
+        """Parameters:
+            G: the DiGraph to track, changed in place by add_edge and
+                remove_edge"""
+        self.G = G
+        self.nodes = list(G.nodes())
+        self.index = {n: i for i, n in enumerate(self.nodes)}
+        n = len(self.nodes)
+        self.in_deg = np.fromiter((d for _, d in G.in_degree()), np.int64, n)
+        self.out_deg = np.fromiter((d for _, d in G.out_degree()), np.int64, n)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def add_edge(self, u, v, **attr):
+        """Add the edge u -> v to the graph, with attributes attr"""
+        new = not self.G.has_edge(u, v)
+        self.G.add_edge(u, v, **attr)
+        if new:
+            # find both positions first, adding a node can grow the arrays
+            iu, iv = self._node(u), self._node(v)
+            self.out_deg[iu] += 1
+            self.in_deg[iv] += 1
+
+    def remove_edge(self, u, v):
+        """Remove the edge u -> v from the graph"""
+        self.G.remove_edge(u, v)
+        self.out_deg[self.index[u]] -= 1
+        self.in_deg[self.index[v]] -= 1
+
+    def dpa_choice(self, u):
+        """Pick a node v other than u with probability equal to its
+        directed preferential attachment score, out_degree(u) *
+        in_degree(v). Makes the same pick as weighted_choice on a dict of
+        those scores for the same random number, None if u is the only
+        node"""
+        n = len(self.nodes)
+        iu = self.index[u]
+        if n < 2:
+            return None
+        in_deg = self.in_deg[:n].copy()
+        in_deg[iu] = 0
+        totals = np.cumsum(in_deg) * self.out_deg[iu]
+        rnd = random() * int(totals[-1])
+        i = int(np.searchsorted(totals, rnd))
+        if i == iu:
+            # only when u is first and rnd is 0, weighted_choice would
+            # skip u and take the next node
+            i += 1
+        return self.nodes[i]
+
+    def _node(self, v):
+        """Position of node v in the arrays, added at the end if new"""
+        i = self.index.get(v)
+        if i is None:
+            i = len(self.nodes)
+            self.index[v] = i
+            self.nodes.append(v)
+            if i == len(self.in_deg):
+                # grow by doubling so adding nodes costs O(1) on average
+                size = max(2 * i, 1)
+                self.in_deg = np.resize(self.in_deg, size)
+                self.out_deg = np.resize(self.out_deg, size)
+            self.in_deg[i] = 0
+            self.out_deg[i] = 0
+        return i
 
-    for w in scores.values():
-        running_total += w
-        totals.append(running_total)
 
-    rnd = random() * running_total
-    for i in range(len(totals)):
-        if rnd <= totals[i]:
-            key = list(scores.keys())[i]
-            return key
-            
-            
 def directed_resource_allocation_index(G, ebunch, resource=1):
     """Implements RA alg for directed graphs"""
     if not nx.is_directed(G):
@@ -72,7 +248,81 @@ def term_subgraph(term, df):
     dat_rows = df[df["text"].str.contains(term)]
     dat_replies = df[df["in_reply_to_tweet_id"].isin(dat_rows["id"].values)]
     hG = nx.DiGraph()
-    for idx in dat_replies.index:
-        row = dat_replies.loc[idx]
-        hG.add_edge(row["in_reply_to_screen_name"], row["user_screen_name"])    
+    hG.add_edges_from(zip(dat_replies["in_reply_to_screen_name"],
+                          dat_replies["user_screen_name"]))
     return hG
+
+
+def load_posts(json_file, nested=None, chunk_size=CHUNK_SIZE):
+    """Load a file of JSON posts, one per line, into a flat DataFrame.
+    The nested user object of every post becomes columns prefixed with
+    user_ (e.g. user_screen_name), the same columns user_to_series made.
+    The file is read and flattened chunk_size lines at a time.
+    nested is the field holding the user, "user" or "account" (found from
+    the first post when None)"""
+    chunks = []
+    with open(json_file, encoding="utf-8") as f:
+        while True:
+            lines = list(islice(f, chunk_size))
+            if not lines:
+                break
+            rows = [json.loads(line) for line in lines if line.strip()]
+            if not rows:
+                continue
+            if nested is None:
+                nested = "account" if "account" in rows[0] else "user"
+            users = [row.pop(nested, None) or {} for row in rows]
+            chunk = pd.DataFrame(rows)
+            user_df = pd.DataFrame(users, index=chunk.index)
+            chunks.append(pd.concat([chunk, user_df.add_prefix("user_")],
+                                    axis=1))
+    if not chunks:
+        return pd.DataFrame()
+    df = pd.concat(chunks, ignore_index=True)
+    # A chunk where a column is always empty gets an object column, which
+    # stops the whole column from getting the type of its values
+    return df.infer_objects()
+
+
+def add_reply_username(df, id_col="in_reply_to_account_id",
+                       user_col="user_id", name_col="user_screen_name",
+                       out_col="in_reply_to_screen_name"):
+    """Return a copy of df with the screen name of the user each post
+    replies to.
+    Each user ID is looked up once in a table built from the first post by
+    every user, instead of searching the whole DataFrame for every reply.
+    Posts that aren't replies, or reply to a user with no posts in df, get
+    NaN."""
+    users = df.drop_duplicates(user_col)
+    users = users[users[user_col].notna()]
+    names = pd.Series(users[name_col].values, index=users[user_col].values)
+    copy = df.copy()
+    copy[out_col] = df[id_col].map(names)
+    return copy
+
+
+def reply_graph(df, source="in_reply_to_screen_name",
+                target="user_screen_name", text="text", agg="sum", G=None):
+    """Build the directed reply graph of a set of posts, with an edge from
+    the user replied to (source) to the user who replied (target).
+    Each edge's capacity is the length of the text of the replies along it,
+    combined with agg: "sum" adds them up, "last" keeps the latest like
+    calling add_edge once per reply did. The pairs are grouped in one pass
+    and the edges added in the order they first appear in df, so the graph
+    is the same as one built row by row. Rows with no source are skipped.
+    Parameters:
+        df: flattened posts, one row per post
+        source: column with the screen name of the user replied to
+        target: column with the screen name of the user who posted
+        text: column with the text of the post
+        agg: how to combine the capacity of repeated replies
+        G: graph to add the edges to (a new DiGraph when None)"""
+    if G is None:
+        G = nx.DiGraph()
+    caps = df[text].str.len().groupby(
+        [df[source], df[target]], sort=False).agg(agg)
+    G.add_edges_from(
+        (u, v, {"capacity": w})
+        for (u, v), w in zip(caps.index, caps.tolist())
+    )
+    return G
@@ -1,23 +1,13 @@
 # -*- coding: utf-8 -*-
-import json
+import multiprocessing as mp
+import os
 import networkx as nx
-from random import choice, random
-import pandas as pd
+from random import choice, getrandbits, random, seed as seed_random
 import graph_funcs as ext
 import scipy.stats as stats
 import numpy as np
 from matplotlib import pyplot as plt
 
-def user_to_series(dict_obj):
-    """Convert a nested JSON user to a flat pandas series"""
-    renamed = {}
-    for k in dict_obj.keys():
-        nk = "user_%s" % k
-        v = dict_obj[k]
-        renamed[nk] = v
-    ret = pd.Series(renamed)
-    return ret
-
 def ncap_weights(G, u):
     u_in = list(G.in_edges(u, data=True))
     if len(u_in) < 1:
@@ -31,15 +21,13 @@ def ncap_weights(G, u):
     n_weight = {k: (Q - n_capacity[k]) for k in n_capacity.keys()}
     return (n_capacity, n_weight)
 
-def wrs_connect(G, u):
-    scores = {}
-    for i in range(len(G.nodes.keys())):
-        v = list(G.nodes.keys())[i]
-        if v == u:
-            continue
-        dpa_score = G.out_degree(u) * G.in_degree(v)      
-        scores[v] = dpa_score
-    return ext.weighted_choice(scores)
+def wrs_connect(G, u, degrees=None):
+    """Pick a node for u to connect to, weighted by the directed
+    preferential attachment score out_degree(u) * in_degree(v).
+    degrees is an ext.DegreeArrays of G, built here when not given"""
+    if degrees is None:
+        degrees = ext.DegreeArrays(G)
+    return degrees.dpa_choice(u)
 
 def wrs_disconnect(G, u):
     u_in = list(G.in_edges(u))
@@ -50,12 +38,14 @@ def wrs_disconnect(G, u):
     if scores is not None:
         return ext.weighted_choice(scores)
 
-def player_one_turn(G, uq, omega):
+def player_one_turn(G, uq, omega, degrees=None):
     if G.has_edge(uq, omega):
         #print("goal node in edges")
         return (omega, G)
     caps = [d["capacity"] for u,v,d in G.edges(data=True)]
     avg_cap = sum(caps) / len(caps)
+    if degrees is None:
+        degrees = ext.DegreeArrays(G)
     
     for u in list(G.nodes.keys()):
         if u == uq:
@@ -68,27 +58,30 @@ def player_one_turn(G, uq, omega):
             #print("path to goal", path)
             pass_to = path[1]
         else:
-            act = ext.weighted_choice(XI)
+            act = XI_SAMPLER.choice()
             if act == "pass":
                 continue
             elif act == "connect":
-                v_conn = wrs_connect(G, u)
+                v_conn = wrs_connect(G, u, degrees)
                 #print("connecting %s to %s" % (u, v_conn))
-                G.add_edge(u, v_conn, capacity=avg_cap)
+                degrees.add_edge(u, v_conn, capacity=avg_cap)
             else:
                 v_disconn = wrs_disconnect(G, u)
                 if v_disconn is None:
                     continue
                 #print("%s disconnecting from" % u, v_disconn)
-                G.remove_edge(v_disconn, u)
+                degrees.remove_edge(v_disconn, u)
     return (pass_to, G)
 
-def player_two_random(G):
+def player_two_random(G, degrees=None):
     e = choice(list(G.edges()))
-    G.remove_edge(*e)
+    if degrees is None:
+        G.remove_edge(*e)
+    else:
+        degrees.remove_edge(*e)
     return G
     
-def player_two_turn(G, uq, omega):
+def player_two_turn(G, uq, omega, degrees=None):
     cut_value, partition = nx.minimum_cut(G, uq, omega)
     reachable, unreachable = partition
     cutset = set()
@@ -97,11 +90,15 @@ def player_two_turn(G, uq, omega):
     caps, scores = ncap_weights(G, omega)
     if len(cutset) >= 2:
         cut = choice(list(cutset))
-        G.remove_edge(*cut)
     elif len(cutset) == 1:
         #print("Single cut to disconnect %s from %s" % (uq, omega))
         cut = list(cutset)[0]
+    else:
+        return G
+    if degrees is None:
         G.remove_edge(*cut)
+    else:
+        degrees.remove_edge(*cut)
     return G
 
 def shortest_path_scores(G):
@@ -132,140 +129,189 @@ def check_win(G, uq, omega):
         #print("\t\tplayer TWO Wins")
         return -1
 
-def simulate(G,num_samples=25,num_sims=25,num_steps=10, rand_player=True):
+def play_games(G, alpha, omega, num_sims, num_steps, rand_player):
+    """Play num_sims games from alpha to omega on copies of G
+    Returns the list of results, 1 for each win by player one and -1 for
+    each win by player two"""
+    game_res = [] # Holds the result of each simulation
+    for i in range(num_sims):
+        newG = G.copy() # Copy the base graph for a new game
+        # Degrees of newG kept up to date as the players change its edges
+        degrees = ext.DegreeArrays(newG)
+        now_at = alpha
+        for j in range(num_steps):
+            w = check_win(newG, now_at, omega)
+            if w is not None:
+                game_res.append(w)
+                break
+            now_at, newG = player_one_turn(newG, now_at, omega, degrees)
+            if not check_win(newG, now_at, omega):
+                if rand_player:
+                    newG = player_two_random(newG, degrees)
+                else:
+                    newG = player_two_turn(newG, now_at, omega, degrees)
+    return game_res
+
+def _init_worker(G):
+    global _worker_graph
+    _worker_graph = G
+
+def _play_sample(task):
+    """Process pool worker. Plays the games of one sample with the global
+    random generator seeded for that sample, so a sample's result doesn't
+    depend on which process plays it"""
+    alpha, omega, num_sims, num_steps, rand_player, seed = task
+    seed_random(seed)
+    return play_games(_worker_graph, alpha, omega, num_sims, num_steps,
+                      rand_player)
+
+def simulate(G,num_samples=25,num_sims=25,num_steps=10, rand_player=True,
+             processes=1, seed=None):
+    """Play num_sims games for each of num_samples (alpha, omega) pairs and
+    return the average result of each sample, in the order they were drawn.
+    The pairs are drawn up front and each sample gets its own seed, so with
+    a seed the results are the same for any number of processes.
+    Parameters:
+        processes: number of processes to play the samples in, None for
+            one per CPU
+        seed: seed for drawing the pairs and the samples' seeds"""
+    if seed is not None:
+        seed_random(seed)
     path_scores = shortest_path_scores(G)
     path_weights = {(p[0][0], p[0][1]): p[2] for p in path_scores}
+    # The sampler builds the running totals once instead of on every draw
+    pairs = ext.WeightedSampler(path_weights)
     played = []
-    pop_avgs = []
+    tasks = []
     for r in range(num_samples):
-        selected = ext.weighted_choice(path_weights)
+        selected = pairs.choice()
         while selected in played:
             # pick a different pair of nodes
-            selected = ext.weighted_choice(path_weights)
+            selected = pairs.choice()
         played.append(selected)
         #print(selected, path_weights[selected])
         alpha = selected[0] # Starting Node
         omega = selected[1] # Goal Node
-        game_res = [] # Holds the result of each simulation
-        for i in range(num_sims):
-            newG = G.copy() # Copy the base graph for a new game
-            now_at = alpha
-            for j in range(num_steps):
-                w = check_win(newG, now_at, omega)
-                if w is not None:
-                    game_res.append(w)
-                    break
-                now_at, newG = player_one_turn(newG, now_at, omega)
-                if not check_win(newG, now_at, omega):
-                    if rand_player:
-                        newG = player_two_random(newG)
-                    else:
-                        newG = player_two_turn(newG, now_at, omega)
-        tally = sum(game_res)
-        avg = tally / len(game_res)
-        pop_avgs.append(float(avg))
-        print(f"Sample {r}: Average {avg}")
+        tasks.append((alpha, omega, num_sims, num_steps, rand_player,
+                      getrandbits(64)))
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes > 1 and len(tasks) > 1:
+        # fork is quickest to start up where the platform has it, and
+        # hands the graph to the workers without pickling it
+        methods = mp.get_all_start_methods()
+        ctx = mp.get_context("fork" if "fork" in methods else None)
+        pool = ctx.Pool(min(processes, len(tasks)), _init_worker, (G,))
+        results = pool.imap(_play_sample, tasks)
+    else:
+        pool = None
+        _init_worker(G)
+        results = map(_play_sample, tasks)
+    pop_avgs = []
+    try:
+        for r, game_res in enumerate(results):
+            tally = sum(game_res)
+            avg = tally / len(game_res)
+            pop_avgs.append(float(avg))
+            print(f"Sample {r}: Average {avg}")
+    except BaseException:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
     return pop_avgs
 
-
 XI = {
     "connect": 2,
     "disconnect": 1,
     "pass": 2
 }
+XI_SAMPLER = ext.WeightedSampler(XI)
 
-############### These are the variables you may want to play with ###############
-retests = 250 # number of times to resample the simulation to create the test population
-k = 25 # number of simulations per game
-n = 50 # number of steps per simulation
-confidence_in_mean = 0.95 # Confidence to use when predicting the population mean
-confidence_in_conclusion = 0.99 # Confidence level used to reject the null hypothesis
-################################################
-
-############### Begin Running the simulations ###############
-G = nx.DiGraph()
+if __name__ == '__main__':
+    # The process pool re-imports this file in its workers where fork isn't
+    # available, so the simulations only run when it is the main script
+    ############### These are the variables you may want to play with ###############
+    retests = 250 # number of times to resample the simulation to create the test population
+    k = 25 # number of simulations per game
+    n = 50 # number of steps per simulation
+    confidence_in_mean = 0.95 # Confidence to use when predicting the population mean
+    confidence_in_conclusion = 0.99 # Confidence level used to reject the null hypothesis
+    processes = None # number of processes to play the games in, None for one per CPU
+    seed = None # set to an int to get the same results on every run
+    ################################################
 
-# process the tweet data to create the network
-series_data = [] # 1 JSON object per tweet object
-with open("fake_tweets.json") as data:
-    text = data.read().strip()
-    rows = text.split("\n")  # JSON objects stored as list of strings
-for row in rows:
-    obj = json.loads(row) # Converted row string to JSON object
-    series_data.append(obj) # Add to JSON list
+    ############### Begin Running the simulations ###############
+    G = nx.DiGraph()
 
-tweet_df = pd.DataFrame(series_data) # 1 row per JSON obj
-tweet_df = pd.concat([tweet_df, tweet_df['user'].apply(user_to_series)], axis=1)
-# Now the data is flattened. We remove the field containing the JSON object
-tweet_df.drop("user", axis=1, inplace=True)
-tweet_df.dropna(axis=0, inplace=True)
-tweet_df["in_reply_to_tweet_id"] = tweet_df["in_reply_to_tweet_id"].astype(int)
-tweet_df["in_reply_to_user_id"] = tweet_df["in_reply_to_user_id"].astype(int)
-tweet_df["user_id"] = tweet_df["user_id"].astype(int)
+    # process the tweet data to create the network
+    # 1 row per tweet, with the nested user flattened into user_ columns
+    tweet_df = ext.load_posts("fake_tweets.json", "user")
+    tweet_df.dropna(axis=0, inplace=True)
+    tweet_df["in_reply_to_tweet_id"] = tweet_df["in_reply_to_tweet_id"].astype(int)
+    tweet_df["in_reply_to_user_id"] = tweet_df["in_reply_to_user_id"].astype(int)
+    tweet_df["user_id"] = tweet_df["user_id"].astype(int)
 
+    # Each edge's capacity is the total length of the replies along it
+    ext.reply_graph(tweet_df, G=G)
 
-for idx in tweet_df.index:
-    row = tweet_df.loc[idx]
-    u = row["in_reply_to_screen_name"]
-    v = row["user_screen_name"]
-    w = len(row["text"])
-    if G.has_edge(u,v):
-        G[u][v]["capacity"] += w
-    else:
-        G.add_edge(u, v, capacity=w)
-        
-# Create the base line with the random player
-print("Testing Random Player 2 strategy:")
-rand_p2_avgs = simulate(G,num_samples=retests,num_sims=k,num_steps=n, rand_player=True)
-rand_p2_pop_avg = np.mean(rand_p2_avgs)
-print(f"Random Player 2 Population Average {rand_p2_pop_avg}")
-#create confidence interval for random player 2 population mean
-rand_p2_pop_interval = stats.t.interval(
-    alpha=confidence_in_mean,
-    df=len(rand_p2_avgs)-1,
-    loc=np.mean(rand_p2_avgs),
-    scale=stats.sem(rand_p2_avgs)
-)
-print(f"Random Player 2 Interval {rand_p2_pop_interval}")
-print("")
+    # Create the base line with the random player
+    print("Testing Random Player 2 strategy:")
+    rand_p2_avgs = simulate(G,num_samples=retests,num_sims=k,num_steps=n, rand_player=True,
+                            processes=processes, seed=seed)
+    rand_p2_pop_avg = np.mean(rand_p2_avgs)
+    print(f"Random Player 2 Population Average {rand_p2_pop_avg}")
+    #create confidence interval for random player 2 population mean
+    rand_p2_pop_interval = stats.t.interval(
+        alpha=confidence_in_mean,
+        df=len(rand_p2_avgs)-1,
+        loc=np.mean(rand_p2_avgs),
+        scale=stats.sem(rand_p2_avgs)
+    )
+    print(f"Random Player 2 Interval {rand_p2_pop_interval}")
+    print("")
 
-# Create the improved player's data
-print("Testing Smarter Player 2 strategy:")
-smart_p2_avgs = simulate(G,num_samples=retests,num_sims=k,num_steps=n, rand_player=False)
-smart_p2_pop_avg = np.mean(smart_p2_avgs)
-print(f"Smart Player 2 Population Average {smart_p2_pop_avg}")
-#create confidence interval for smart player 2 population mean
-smart_p2_pop_interval = stats.t.interval(
-    alpha=confidence_in_mean,
-    df=len(smart_p2_avgs)-1,
-    loc=np.mean(smart_p2_avgs),
-    scale=stats.sem(smart_p2_avgs)
-)
-print(f"Smart Player 2 Interval {smart_p2_pop_interval}")
+    # Create the improved player's data
+    print("Testing Smarter Player 2 strategy:")
+    smart_p2_avgs = simulate(G,num_samples=retests,num_sims=k,num_steps=n, rand_player=False,
+                             processes=processes, seed=seed)
+    smart_p2_pop_avg = np.mean(smart_p2_avgs)
+    print(f"Smart Player 2 Population Average {smart_p2_pop_avg}")
+    #create confidence interval for smart player 2 population mean
+    smart_p2_pop_interval = stats.t.interval(
+        alpha=confidence_in_mean,
+        df=len(smart_p2_avgs)-1,
+        loc=np.mean(smart_p2_avgs),
+        scale=stats.sem(smart_p2_avgs)
+    )
+    print(f"Smart Player 2 Interval {smart_p2_pop_interval}")
 
-# Run the one-tailed T-Test. We are asserting the random player's mean 
-# will be strictly greater than the mean of the improved player's
-ttest_score = abs(stats.ttest_ind(rand_p2_avgs, smart_p2_avgs, alternative='greater').pvalue)
-thresh = 1-confidence_in_conclusion
-if thresh < ttest_score:
-    print("We cannot reject the null hypothesis. No significant difference detected.")
-else:
-    print("We can reject the null hypothesis. The two samples are significantly different")
+    # Run the one-tailed T-Test. We are asserting the random player's mean 
+    # will be strictly greater than the mean of the improved player's
+    ttest_score = abs(stats.ttest_ind(rand_p2_avgs, smart_p2_avgs, alternative='greater').pvalue)
+    thresh = 1-confidence_in_conclusion
+    if thresh < ttest_score:
+        print("We cannot reject the null hypothesis. No significant difference detected.")
+    else:
+        print("We can reject the null hypothesis. The two samples are significantly different")
 
-xmin = -1 # no game can score lower than -1
-xmax = 1 # no game can score higher than +1
-X1 = stats.norm(np.mean(rand_p2_avgs), np.std(rand_p2_avgs)) # Random Player normal distribution
-xs1 = np.linspace(xmin,xmax,50)  # create 100 x values in that range
-plt.plot(xs1,X1.pdf(xs1), "--.", alpha=0.33) # plot the shape of the distribution
+    xmin = -1 # no game can score lower than -1
+    xmax = 1 # no game can score higher than +1
+    X1 = stats.norm(np.mean(rand_p2_avgs), np.std(rand_p2_avgs)) # Random Player normal distribution
+    xs1 = np.linspace(xmin,xmax,50)  # create 100 x values in that range
+    plt.plot(xs1,X1.pdf(xs1), "--.", alpha=0.33) # plot the shape of the distribution
 
-X2 = stats.norm(np.mean(smart_p2_avgs), np.std(smart_p2_avgs)) # Smart Player normal distribution
-xs2 = np.linspace(xmin,xmax,100)  # create 100 x values in that range
-plt.plot(xs2,X2.pdf(xs2)) # plot the shape of the distribution
-plt.legend(["Random Player", "Smart Player"])
-plt.yticks([])
-plt.ylabel("Likelihood")
-plt.xlabel("Population Result")
-plt.title("Simulation Score Distribution")
-#plt.savefig("Figure_6-4.png")
-#plt.savefig("Figure_6-4.svg", format="svg")
-plt.show()
+    X2 = stats.norm(np.mean(smart_p2_avgs), np.std(smart_p2_avgs)) # Smart Player normal distribution
+    xs2 = np.linspace(xmin,xmax,100)  # create 100 x values in that range
+    plt.plot(xs2,X2.pdf(xs2)) # plot the shape of the distribution
+    plt.legend(["Random Player", "Smart Player"])
+    plt.yticks([])
+    plt.ylabel("Likelihood")
+    plt.xlabel("Population Result")
+    plt.title("Simulation Score Distribution")
+    #plt.savefig("Figure_6-4.png")
+    #plt.savefig("Figure_6-4.svg", format="svg")
+    plt.show()